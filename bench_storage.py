@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from export import FORMATS, export_file, rankings
+from messages import anims_message, info_message, players_message, status_message, top_message, total_rank_message
+from storage import SqliteStorage, Storage, convert
+
+
+def generate(path: str, n_players: int, n_anims: int, enrollments: int, rng: random.Random) -> None:
+    """Write a synthetic storage.csv where every player is enrolled in `enrollments` random anims."""
+    anims = [f"anim{i}" for i in range(n_anims)]
+    with open(path, "w") as dest:
+        for i in range(n_players):
+            player = f"player{i}"
+            player_anims = rng.sample(anims, min(enrollments, n_anims))
+            if len(player_anims) == 0:
+                dest.write(player + "\n")
+            for anim in player_anims:
+                dest.write(f"{player},{anim},{rng.randrange(1000)}\n")
+
+
+def timeit(func, args_list) -> dict:
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        "n": len(timings),
+        "mean_us": sum(timings) / len(timings) * 1e6,
+        "min_us": timings[0] * 1e6,
+        "median_us": timings[len(timings) // 2] * 1e6,
+        "max_us": timings[-1] * 1e6
+    }
+
+
+def open_storage(backend: str, csv_path: str):
+    if backend == "sqlite":
+        return SqliteStorage(csv_path[:-len(".csv")] + ".db")
+    if backend == "binary":
+        return Storage(csv_path[:-len(".csv")] + ".bin")
+    return Storage(csv_path, journal=backend == "journal")
+
+
+def bench(backend: str, n_players: int, n_anims: int, args, rng: random.Random) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "storage.csv")
+        generate(csv_path, n_players, n_anims, args.enrollments, rng)
+        if backend == "sqlite":
+            convert(csv_path, os.path.join(tmp, "storage.db"))
+        elif backend == "binary":
+            convert(csv_path, os.path.join(tmp, "storage.bin"))
+
+        start = time.perf_counter()
+        storage = open_storage(backend, csv_path)
+        load = time.perf_counter() - start
+
+        players = [f"player{rng.randrange(n_players)}" for _ in range(args.ops)]
+        anims = [f"anim{rng.randrange(n_anims)}" for _ in range(args.ops)]
+        enrollments = [
+            (player, next(iter(storage.read(player)), anims[0]))
+            for player in players
+        ]
+        existing_anims = [anim for anim in anims if anim in storage.anims] or [None]
+
+        def add_save(player, anim, points):
+            storage.add(player, anim, points)
+            storage.save()
+
+        def remove(player, anim):
+            storage.remove(player, anim)
+
+        results = {
+            "backend": backend,
+            "players": n_players,
+            "anims": n_anims,
+            "enrollments": args.enrollments,
+            "load_us": load * 1e6,
+            "add": timeit(storage.add, [(p, a, 1) for p, a in enrollments]),
+            "add_save": timeit(add_save, [(p, a, 1) for p, a in enrollments[:args.save_ops]]),
+            "read_anim": timeit(lambda a: storage.read(anim=a), [(a,) for a in existing_anims]),
+            "status": timeit(
+                lambda a, p: status_message(storage, a, p),
+                [(a, p) for a, p in zip(existing_anims, players)]
+            ),
+            "info": timeit(lambda p: info_message(storage, p), [(p,) for p in players]),
+            "top": timeit(
+                lambda p: top_message(storage) + total_rank_message(storage, p), [(p,) for p in players]
+            ),
+            "list_players": timeit(lambda: players_message(storage), [()] * args.listing_ops),
+            "list_anims": timeit(lambda: anims_message(storage), [()] * args.listing_ops),
+            # misspelled names, the first search also builds the index
+            "search": timeit(lambda p: storage.search_players(p[:-2] + "x" + p[-1:], 5), [(p,) for p in players]),
+            # copying the rankings, done under the storage lock, then writing them
+            "export": {
+                "rankings": timeit(lambda: rankings(storage), [()]),
+                **{
+                    fmt + (".gz" if compress else ""): timeit(
+                        lambda f, c: export_file(rankings(storage), f, c).close(), [(fmt, compress)]
+                    )
+                    for fmt in FORMATS for compress in (False, True)
+                }
+            },
+            # last, as it shrinks the dataset
+            "remove": timeit(remove, list(dict.fromkeys(enrollments)))
+        }
+        if backend == "journal":
+            storage.journal.close()
+        elif backend == "sqlite":
+            storage.db.close()
+        return results
+
+
+def bench_startup(n_records: int, args, rng: random.Random) -> dict:
+    """Compare the time taken to load the same records from storage.csv and from a binary snapshot."""
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "storage.csv")
+        bin_path = os.path.join(tmp, "storage.bin")
+        generate(csv_path, n_records // args.enrollments, max(args.anims), args.enrollments, rng)
+        convert(csv_path, bin_path)
+        results = {"records": n_records, "csv_bytes": os.path.getsize(csv_path), "bin_bytes": os.path.getsize(bin_path)}
+        for name, path in (("csv", csv_path), ("binary", bin_path)):
+            results[name] = timeit(Storage, [(path,)] * args.startup_runs)
+        return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Storage on synthetic datasets, results are printed as JSON")
+    parser.add_argument("--players", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--anims", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--enrollments", type=int, default=3, help="anims joined by each player")
+    parser.add_argument("--backend", nargs="+", choices=["csv", "journal", "binary", "sqlite"], default=["csv"])
+    parser.add_argument("--ops", type=int, default=200, help="operations timed per measure")
+    parser.add_argument("--save-ops", type=int, default=10, help="operations timed when saving each time")
+    parser.add_argument("--listing-ops", type=int, default=5, help="operations timed for /players and /anims")
+    parser.add_argument("--startup", action="store_true", help="only compare startup times from CSV and binary snapshots")
+    parser.add_argument("--records", type=int, nargs="+", default=[10000, 100000], help="records loaded with --startup")
+    parser.add_argument("--startup-runs", type=int, default=3, help="loads timed per measure with --startup")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="file to write the results to, instead of stdout")
+
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.startup:
+        results = [bench_startup(n_records, args, rng) for n_records in args.records]
+    else:
+        results = [
+            bench(backend, n_players, n_anims, args, rng)
+            for backend in args.backend
+            for n_players in args.players
+            for n_anims in args.anims
+        ]
+
+    if args.output:
+        with open(args.output, "w") as dest:
+            json.dump(results, dest, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,65 @@
+import argparse
+import base64
+import json
+import random
+import time
+
+from messages import ReplyCache
+from nfc_payload import sign_all
+from tokens import read_legacy, sign, verify
+
+SECRET = "bench"
+
+
+def rate(func, args_list) -> dict:
+    start = time.perf_counter()
+    for args in args_list:
+        func(*args)
+    elapsed = time.perf_counter() - start
+    return {"n": len(args_list), "per_s": len(args_list) / elapsed, "mean_us": elapsed / len(args_list) * 1e6}
+
+
+def bench(n_cards: int, args, rng: random.Random) -> dict:
+    secret = SECRET.encode("utf-8")
+    players = [f"player{i}" for i in range(n_cards)]
+    tokens = [sign(player, secret) for player in players]
+    legacy = [base64.b64encode(f"{player} {SECRET}".encode("utf-8")).decode("ascii") for player in players]
+    # a station scans the cards of the players queuing at it, several times each
+    scans = [rng.choice(tokens[:args.station_cards]) for _ in range(args.scans)]
+    cache = ReplyCache(args.cache_size)
+
+    results = {
+        "cards": n_cards,
+        "sign": rate(sign, [(player, secret) for player in players]),
+        "verify": rate(verify, [(token, secret) for token in tokens]),
+        "legacy_decode": rate(read_legacy, [(payload, SECRET) for payload in legacy]),
+        "verify_cached": rate(lambda token: cache.get(token, lambda: verify(token, secret)), [(t,) for t in scans])
+    }
+    results["verify_cached"]["hit_rate"] = cache.hit_rate
+    for workers in args.workers:
+        start = time.perf_counter()
+        sign_all(players, secret, workers)
+        results[f"sign_all_{workers}_workers"] = {"per_s": n_cards / (time.perf_counter() - start)}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the signing and verification of NFC card tokens, results are printed as JSON")
+    parser.add_argument("--cards", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="processes used to sign a roster")
+    parser.add_argument("--scans", type=int, default=10000, help="scans verified through the cache")
+    parser.add_argument("--station-cards", type=int, default=200, help="distinct cards among the scans")
+    parser.add_argument("--cache-size", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="file to write the results to, instead of stdout")
+
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = [bench(n_cards, args, rng) for n_cards in args.cards]
+
+    if args.output:
+        with open(args.output, "w") as dest:
+            json.dump(results, dest, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
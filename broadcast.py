@@ -0,0 +1,96 @@
+import logging
+import os
+from typing import Union
+
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import ContextTypes
+
+from messages import status_message
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """
+    Keeps a pinned message per anim in a channel, showing its ranking as /status
+    does. Each push only renders the anims changed since the previous one, and
+    only edits the messages whose text actually changed, so that a busy anim
+    costs at most one edit per push. Message ids are saved to `path`, so that
+    the same messages are edited after a restart.
+    """
+
+    def __init__(self, storage, chat_id: Union[int, str], path: str="./channel.csv"):
+        self.storage = storage
+        self.chat_id = chat_id
+        self.path = path
+        # anim -> id of its message in the channel
+        self.messages = {}
+        if os.path.exists(path):
+            for line in open(path, "r").read().splitlines():
+                anim, message_id = line.split(",")
+                self.messages[anim] = int(message_id)
+        # anim -> text last pushed, unknown for the messages posted before a restart
+        self.texts = {}
+        # anims to render at the next push, all of them at first
+        self.pending = set(storage.anims) | set(self.messages)
+        self.edits = 0
+        self.skipped = 0
+        self.errors = 0
+
+
+    def _save(self) -> None:
+        with open(self.path, "w") as dest:
+            dest.write("".join(f"{anim},{message_id}\n" for anim, message_id in self.messages.items()))
+
+
+    async def push(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # handlers don't await while changing the storage, so it can't be caught mid-change here
+        self.pending |= self.storage.changed()
+        for anim in sorted(self.pending):
+            try:
+                await self._update(context.bot, anim)
+            except RetryAfter as e:
+                # the anims left are pushed next time
+                logger.warning(f"Flood limit reached in the channel, {len(self.pending)} rankings delayed by {e.retry_after}s")
+                return
+            except TelegramError as e:
+                self.errors += 1
+                logger.error(f"Could not update the ranking of {anim} in the channel: {e}")
+            self.pending.discard(anim)
+
+
+    async def _update(self, bot: Bot, anim: str) -> None:
+        message_id = self.messages.get(anim)
+        if anim not in self.storage.anims:
+            # the anim is gone, and so is its ranking
+            if message_id != None:
+                self.messages.pop(anim)
+                self.texts.pop(anim, None)
+                self._save()
+                await bot.delete_message(self.chat_id, message_id)
+            return
+
+        text = status_message(self.storage, anim)
+        if text == self.texts.get(anim):
+            self.skipped += 1
+            return
+        if message_id != None:
+            try:
+                await bot.edit_message_text(text, self.chat_id, message_id)
+                self.edits += 1
+            except BadRequest as e:
+                if "not modified" in e.message:
+                    self.skipped += 1
+                elif "not found" in e.message:
+                    # deleted from the channel, it is posted again
+                    message_id = None
+                else:
+                    raise
+        if message_id == None:
+            message = await bot.send_message(self.chat_id, text, disable_notification=True)
+            self.messages[anim] = message.message_id
+            self._save()
+            self.edits += 1
+            await bot.pin_chat_message(self.chat_id, message.message_id, disable_notification=True)
+        self.texts[anim] = text
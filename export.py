@@ -0,0 +1,90 @@
+import csv
+import gzip
+import io
+import json
+import tempfile
+from itertools import groupby
+from typing import IO, Iterator, List, Tuple
+
+# formats of /export, gzipped when suffixed with ".gz"
+FORMATS = ("csv", "json")
+# exports larger than this are written to disk rather than kept in memory
+SPOOL_SIZE = 1 << 20
+# faster than the default 9, for files barely larger
+COMPRESS_LEVEL = 6
+
+
+def rankings(storage, anim: str=None) -> List[Tuple[str, List[Tuple[str, float]]]]:
+    """
+    Copy of the ranking of every anim, or only `anim`, followed by the overall
+    ranking under the anim None unless `anim` is given. Only references to the
+    names are copied, so that the storage can be released before formatting.
+    """
+    anims = [anim] if anim != None else sorted(storage.anims)
+    copy = [(a, storage.top(a)) for a in anims]
+    if anim == None:
+        copy.append((None, storage.top_totals()))
+    return copy
+
+
+def rows(rankings: List[Tuple[str, List[Tuple[str, float]]]]) -> Iterator[Tuple[str, int, str, float]]:
+    """(anim, rank, player, points) for each line of `rankings`."""
+    for anim, ranking in rankings:
+        for idx, (player, points) in enumerate(ranking):
+            yield anim, idx + 1, player, points
+
+
+def write_csv(rows: Iterator[Tuple[str, int, str, float]], dest: IO[str]) -> None:
+    # the overall ranking has an empty anim
+    out = csv.writer(dest)
+    out.writerow(["anim", "rank", "player", "points"])
+    for anim, rank, player, points in rows:
+        out.writerow([anim or "", rank, player, points])
+
+
+def write_json(rows: Iterator[Tuple[str, int, str, float]], dest: IO[str]) -> None:
+    # written row by row, as {"anims": {<anim>: [<row>, ...], ...}, "totals": [<row>, ...]}
+    dest.write('{"anims": {')
+    totals = False
+    for idx, (anim, group) in enumerate(groupby(rows, key=lambda row: row[0])):
+        if anim == None:
+            dest.write('}, "totals": [')
+            totals = True
+        else:
+            dest.write(("" if idx == 0 else ", ") + json.dumps(anim, ensure_ascii=False) + ": [")
+        for i, (_, rank, player, points) in enumerate(group):
+            if i > 0:
+                dest.write(", ")
+            # only the name needs escaping
+            dest.write(f'{{"rank": {rank}, "player": {json.dumps(player, ensure_ascii=False)}, "points": {points}}}')
+        dest.write("]")
+    dest.write("}" if totals else "}}")
+
+
+def export_file(
+    rankings: List[Tuple[str, List[Tuple[str, float]]]],
+    fmt: str="csv",
+    compress: bool=False
+) -> IO[bytes]:
+    """
+    Write `rankings` in `fmt`, gzipped if `compress`, to a temporary file
+    returned rewound. Rows are written one by one, so that the export is never
+    held in a single string.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}")
+    file = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    archive = gzip.GzipFile(fileobj=file, mode="wb", compresslevel=COMPRESS_LEVEL) if compress else None
+    text = io.TextIOWrapper(archive or file, encoding="utf-8", newline="")
+    try:
+        (write_csv if fmt == "csv" else write_json)(rows(rankings), text)
+        text.flush()
+        # the temporary file stays open for the caller
+        text.detach()
+        if archive != None:
+            archive.close()
+    except:
+        file.close()
+        raise
+    file.seek(0)
+    return file
@@ -0,0 +1,121 @@
+import os
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Callable, List
+
+from storage import read_log
+
+
+class Event:
+    __slots__ = ("ts", "admin", "player", "anim", "delta", "removed", "undoes", "undone")
+
+    def __init__(
+        self,
+        ts: float,
+        admin: int,
+        player: str,
+        anim: str,
+        delta: int,
+        removed: bool=False,
+        undoes: int=None
+    ):
+        self.ts = ts
+        self.admin = admin
+        self.player = player
+        self.anim = anim
+        self.delta = delta
+        # the player was unenrolled from the anim, losing -delta points
+        self.removed = removed
+        # index of the event cancelled by this one
+        self.undoes = undoes
+        self.undone = False
+
+
+class History:
+    """
+    Every change of the points of a player in an anim, in time order, appended to
+    `path` as `ts,admin,player,anim,delta,removed,undoes` lines. Events are
+    indexed by time, by anim and by admin, so that queries over the last minutes,
+    the activity of an anim and the last entry of an admin don't go through the
+    whole history.
+    """
+
+    def __init__(self, path: str="./history.csv"):
+        self.path = path
+        self.events = []
+        # timestamps of the events, non-decreasing
+        self.times = array("d")
+        # anim -> indexes of its events
+        self.anim_events = {}
+        # admin -> indexes of their events
+        self.admin_events = {}
+        if os.path.exists(path):
+            for line in read_log(path):
+                record = line.split(",")
+                self._append(Event(
+                    float(record[0]), int(record[1]), record[2], record[3], int(record[4]),
+                    record[5] == "1", int(record[6]) if record[6] != "" else None
+                ))
+        self.file = open(path, "a")
+
+
+    def _append(self, event: Event) -> int:
+        idx = len(self.events)
+        # the clock may go back a little, the order of the events is what matters
+        if len(self.times) > 0 and event.ts < self.times[-1]:
+            event.ts = self.times[-1]
+        self.events.append(event)
+        self.times.append(event.ts)
+        self.anim_events.setdefault(event.anim, array("I")).append(idx)
+        self.admin_events.setdefault(event.admin, array("I")).append(idx)
+        if event.undoes != None:
+            self.events[event.undoes].undone = True
+        return idx
+
+
+    def record(
+        self,
+        admin: int,
+        player: str,
+        anim: str,
+        delta: int,
+        removed: bool=False,
+        undoes: int=None
+    ) -> int:
+        event = Event(time.time(), admin, player, anim, delta, removed, undoes)
+        idx = self._append(event)
+        self.file.write(
+            f"{event.ts:.3f},{admin},{player},{anim},{delta},{int(removed)},{'' if undoes == None else undoes}\n"
+        )
+        self.file.flush()
+        return idx
+
+
+    def since(self, ts: float, anim: str=None) -> List[Event]:
+        """Events recorded since `ts`, oldest first, only those of `anim` if given."""
+        if anim == None:
+            return self.events[bisect_left(self.times, ts):]
+        indexes = self.anim_events.get(anim, ())
+        start = bisect_left(indexes, ts, key=lambda idx: self.times[idx])
+        return [self.events[idx] for idx in indexes[start:]]
+
+
+    def activity(self, ts: float) -> Counter:
+        """Number of events of each anim since `ts`."""
+        return Counter(event.anim for event in self.since(ts))
+
+
+    def last(self, admin: int, undoable: Callable[[Event], bool]) -> int:
+        """Index of the last event of `admin` not undone yet and `undoable`, None if there is none."""
+        indexes = self.admin_events.get(admin, ())
+        for idx in reversed(indexes):
+            event = self.events[idx]
+            if not event.undone and event.undoes == None and undoable(event):
+                return idx
+        return None
+
+
+    def close(self) -> None:
+        self.file.close()
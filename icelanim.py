@@ -1,24 +1,80 @@
+import asyncio
+import importlib.util
 import logging
 import os
-import base64
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
-from operator import itemgetter
 
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram import (
+    Update,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove
+)
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     Application,
+    CallbackQueryHandler,
     CommandHandler,
     ConversationHandler,
+    InlineQueryHandler,
     MessageHandler,
     ContextTypes,
     filters
 )
 
+from messages import (
+    PAGE_SIZE,
+    STATUS_TOP,
+    SUGGESTIONS,
+    TOP_MAX,
+    ReplyCache,
+    anims_message,
+    did_you_mean,
+    info_message,
+    pages,
+    players_message,
+    rank_message,
+    recent_message,
+    status_message,
+    teams_message,
+    top_message,
+    total_rank_message
+)
+from broadcast import Broadcaster
+from export import FORMATS, export_file, rankings
+from history import Event, History
+from metrics import Metrics
+from outbox import ADMIN, MAX_LENGTH, NORMAL, READ, Outbox, OutboxApplication
+from persistence import ConversationPersistence
+from profiler import Profiler
+from storage import SqliteStorage, Storage
+from tokens import read_legacy, verify
+
 keys = dict(line.split(",") for line in open(".keys", "r").read().splitlines())
+# the cards are signed with their own key, so that the event's code can be given out
+card_secret = keys["secret"].encode("utf-8")
 if os.path.exists(".admins"):
     admins = set(int(line) for line in open(".admins", "r").read().splitlines())
 else:
     admins = set()
+if os.path.exists(".weights"):
+    # anims counting more or less than the others in /top
+    weights = {}
+    for line in open(".weights", "r").read().splitlines():
+        anim, weight = line.split(",")
+        weights[anim] = float(weight) if "." in weight else int(weight)
+else:
+    weights = {}
+if os.path.exists(".config"):
+    config = dict(line.split(",") for line in open(".config", "r").read().splitlines())
+else:
+    config = {}
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -31,6 +87,10 @@ PLAYER, ANIM, CREATE_ANIM, ADD_TO_ANIM, POINTS, SAVE = range(6)
 REGISTER_PLAYER, ADD_ANIM, ADD_ANIM_REPLY, REGISTER_ANIM = range(4)
 # wipe a player's record, or remove them from a single anim
 REMOVE, REMOVE_PROCEED, REMOVE_REPLY, REMOVE_PLAYER, REMOVE_ANIM_1, REMOVE_ANIM_2 = range(6)
+# enter many points at once
+BULK = 0
+# players and anims suggested by inline queries
+INLINE_RESULTS = 10
 
  
 def sanitize_player(player: str) -> str:
@@ -41,112 +101,205 @@ def sanitize_anim(anim: str) -> str:
     return anim.replace(",", "").strip()
 
 
-class Storage:
-
-    def __init__(self, path: str="./storage.csv"):
-        self.path = path
-        with open(path, "r") as src:
-            self.storage = {}
-            self.anims = set()
-            self.players = set()
-            for line in src.read().splitlines():
-                data = line.split(",")
-                if len(data) >= 1:
-                    player = data[0]
-                    if player not in self.storage:
-                        self.players.add(player)
-                        self.storage[player] = {}
-                if len(data) >= 2:
-                    anim = data[1]
-                    if anim not in self.anims:
-                        self.anims.add(anim)
-                    if anim not in self.storage[player]:
-                        self.storage[player] = {anim: 0}
-                if len(data) >= 3:
-                    points = data[2]
-                    self.storage[player][anim] = points
-
-
-    def save(self) -> None:
-        with open(self.path, "w") as dest:
-            for player, anims_points in self.storage.items():
-                data = list(anims_points.items())
-                if len(data) == 0:
-                    dest.write(player + "\n")
-                else:
-                    for anim, points in data:
-                        dest.write(",".join((player, anim, str(points))) + "\n")
-
-
-    def add(self, player: str, anim: str=None, points: int=None) -> None:
-        if (
-            not isinstance(player, str) or
-            anim != None and not isinstance(anim, str)
-        ):
-            raise TypeError("Expected strings")
-
-        if player not in self.players:
-            self.players.add(player)
-            self.storage[player] = {}
-        if anim != None:
-            if anim not in self.storage[player]:
-                if anim not in self.anims:
-                    self.anims.add(anim)
-                self.storage[player][anim] = points or 0
-            elif points != None:
-                self.storage[player][anim] += points
-
-
-    def remove(self, player: str, anim: str=None) -> None:
-        if (
-            not isinstance(player, str) or
-            anim != None and not isinstance(anim, str)
-        ):
-            raise TypeError("Expected strings")
-        
-        if player in self.players:
-            if anim == None:
-                self.players.remove(player)
-                self.storage.pop(player)
-            else:
-                self.storage[player].pop(anim)
-                count = len(set(p for p in self.players if anim in self.storage[p]))
-                if count == 0:
-                    self.anims.remove(anim)
-
-
-    def read(self, player: str=None, anim: str=None):
-        if (
-            anim != None and not isinstance(anim, str) or
-            player != None and not isinstance(player, str)
-        ):
-            raise TypeError("Expected strings")
-
-        if (
-            anim != None and anim not in self.anims or
-            player != None and player not in self.players
-        ):
-            raise TypeError("Expected strings")
-
-        if anim != None:
-            if player != None:
-                return self.storage[player][anim]
-            else:
-                return {p: self.storage[p][anim] for p in self.storage if anim in self.storage[p]}
-        else:
-            if player != None:
-                return self.storage[player]
-            else:
-                raise Exception("At least one arg must be specified")
+def sanitize_team(team: str) -> str:
+    return team.replace(",", "").strip()
+
+
+def read_card(payload: str) -> str:
+    """The player a card belongs to, None if it was not written for this event."""
+    player = verify(payload, card_secret)
+    if player == None and config.get("legacy_cards", "0") == "1":
+        player = read_legacy(payload, keys["code"])
+    return player
+
+
+class StorageWriter:
+    """
+    Persists `storage` in the background, done in a worker thread so that the
+    event loop never waits on disk. Handlers call `request()` after a change,
+    and all the changes made within `interval` seconds are flushed with a
+    single write. Handlers confirming a change to the user await `commit()`
+    instead: the flush then starts `window` seconds later, and covers every
+    change made in the meantime.
+    """
+
+    def __init__(self, storage: Storage, interval: float, window: float, lock: asyncio.Lock, metrics: Metrics):
+        self.storage = storage
+        self.interval = interval
+        self.window = window
+        self.lock = lock
+        self.metrics = metrics
+        self.wakeup = asyncio.Event()
+        self.urgent = asyncio.Event()
+        # done once the next flush is on disk
+        self.committed = None
+        # a single worker keeps the writes ordered
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.task = None
+        self.commits = 0
+        self.flushes = 0
+
+
+    def request(self) -> None:
+        self.wakeup.set()
+
+
+    async def commit(self) -> None:
+        """Return once the changes made so far are on disk."""
+        if self.committed == None:
+            self.committed = asyncio.get_running_loop().create_future()
+        committed = self.committed
+        self.commits += 1
+        self.urgent.set()
+        self.wakeup.set()
+        # the flush is shared, a cancelled handler must not cancel it for the others
+        await asyncio.shield(committed)
+
+
+    async def _flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        # a SQLite commit shares the connection with the handlers, which must not write until it is done
+        hold = isinstance(self.storage, SqliteStorage)
+        try:
+            async with self.lock:
+                start = time.perf_counter()
+                committed, self.committed = self.committed, None
+                job = self.storage.flush()
+                if hold:
+                    await loop.run_in_executor(self.executor, job)
+            if not hold:
+                await loop.run_in_executor(self.executor, job)
+        except Exception as e:
+            logger.error(f"Could not save the storage: {e}")
+            # saved again by the next flush, at the latest when the bot stops
+            self.storage.dirty = True
+            if committed != None:
+                committed.set_exception(e)
+            return
+        self.flushes += 1
+        self.metrics.observe("Storage.save", time.perf_counter() - start)
+        if committed != None:
+            committed.set_result(None)
+
+
+    async def run(self) -> None:
+        while True:
+            await self.wakeup.wait()
+            try:
+                await asyncio.wait_for(self.urgent.wait(), self.interval)
+                await asyncio.sleep(self.window)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            self.urgent.clear()
+            await self._flush()
+
+
+    async def start(self, application: Application) -> None:
+        self.task = asyncio.create_task(self.run())
+
+
+    async def stop(self, application: Application) -> None:
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        if self.storage.dirty or self.committed != None:
+            await self._flush()
+        self.executor.shutdown()
+
+
+if config.get("backend", "csv") == "sqlite":
+    # the teams are kept in the database
+    storage = SqliteStorage(config.get("database", "./storage.db"), weights=weights)
+else:
+    storage = Storage(
+        "./storage.bin" if config.get("snapshot", "csv") == "binary" else "./storage.csv",
+        journal=config.get("journal", "0") == "1",
+        journal_limit=int(config.get("journal_limit", 1000)),
+        compact_interval=float(config.get("compact_interval", 600)),
+        weights=weights,
+        teams_path=config.get("teams", "./teams.csv")
+    )
+# serializes the handlers that modify `storage`, as updates may be processed concurrently
+storage_lock = asyncio.Lock()
+metrics = Metrics()
+profiler = Profiler(config.get("profile_dir", "."))
+metrics.profiler = profiler
+writer = StorageWriter(
+    storage,
+    float(config.get("flush_interval", 500)) / 1000,
+    float(config.get("commit_window", 20)) / 1000,
+    storage_lock,
+    metrics
+)
+cache = ReplyCache(int(config.get("cache_size", 256)))
+# NFC card payload -> player
+cards = ReplyCache(int(config.get("card_cache_size", 1024)))
+history = History(config.get("history", "./history.csv"))
+outbox = Outbox(float(config.get("chat_rate", 1)), float(config.get("global_rate", 30)))
+if "channel" in config:
+    # the channel's id, or @username for a public channel
+    channel = config["channel"]
+    broadcaster = Broadcaster(
+        storage,
+        int(channel) if channel.lstrip("-").isdigit() else channel,
+        config.get("channel_messages", "./channel.csv")
+    )
+else:
+    broadcaster = None
+if config.get("persistence", "0") == "1":
+    # conversations in progress and their user_data survive restarts
+    persistence = ConversationPersistence(
+        config.get("persistence_file", "./conversations.pickle"),
+        float(config.get("persistence_interval", 5))
+    )
+else:
+    persistence = None
 
 
-storage = Storage()
+def reply(update: Update, text: str, reply_markup=None, priority: int=None) -> None:
+    # admins entering scores are answered before everyone else
+    if priority == None:
+        priority = ADMIN if update.effective_user.id in admins else NORMAL
+    outbox.reply(update, text, reply_markup, priority)
 
 
 def build_keyboard(buttons: List[str], n_cols: int) -> List[List[str]]:
     return [buttons[i:i + n_cols] for i in range(0, len(buttons), n_cols)]
 
 
+async def send_document(chat_id: int, data: bytes, filename: str, caption: str) -> bool:
+    """Send `data` as the file `filename`, returning False if it could not be sent."""
+    # documents don't go through the outbox, which only sends text, but they are sent by its bot
+    try:
+        await outbox.bot.send_document(chat_id, data, filename=filename, caption=caption)
+    except TelegramError as e:
+        logger.error(f"Could not send {filename}: {e}")
+        return False
+    return True
+
+
+async def committed(update: Update) -> bool:
+    """
+    Wait for the changes made so far to be on disk. If they could not be
+    saved, the admin is told that they are recorded anyway, so that they are
+    not entered twice, and False is returned.
+    """
+    try:
+        await writer.commit()
+    except Exception:
+        # logged by the writer, which saves them again at its next flush
+        reply(
+            update,
+            "⚠️ C'est bien enregistré, mais pas encore sauvé sur le disque ⚠️\n\n> Ne rentre pas ces changements une deuxième fois, ils seront sauvés dès que possible.",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        return False
+    return True
+
+
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = """
 /players
@@ -160,7 +313,14 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     - Renvoie la liste des points obtenus par un joueur au sein de toutes les animations
 
 /status <animation>
-    Renvoie la liste des points obtenus par tous les joueurs inscrits à l'animation"""
+    Renvoie la liste des points obtenus par tous les joueurs inscrits à l'animation
+
+/top <nombre | 10>
+    Renvoie le classement général, tous points confondus
+
+/teams <animation | None>
+    Renvoie le classement des équipes, dans une animation ou tous points
+    confondus"""
     if update.message.from_user.id in admins:
         message += """
 
@@ -176,27 +336,57 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 /remove
     - Supprime un joueur de la base de donnée, ou
     - Désinscrit un joueur d'une animation
+
+/recent <minutes | 15> <animation | None>
+    Renvoie les points entrés ces dernières minutes, pour toutes les animations
+    ou une seule
+
+/undo
+    Annule ta dernière entrée de points ou désinscription
+
+/team <joueur> <équipe | None>
+    Place un joueur dans une équipe, ou le retire de son équipe
+
+/stats
+    Renvoie le nombre d'appels, les erreurs et la latence de chaque commande
+
+/profile <secondes | 30> <commandes | None>
+    Profile le bot pendant le nombre de secondes donné, ou jusqu'à ce que le
+    nombre de commandes donné ait été traité, et renvoie le résumé
+
+/bulk
+    Entrer des points pour plusieurs joueurs d'un coup, à partir de lignes
+    <joueur>,<animation>,<points> collées ou d'un fichier CSV
+
+/export <csv | json> <animation | None>
+    Renvoie le classement de chaque animation et le classement général dans
+    un fichier, compressé avec csv.gz ou json.gz
     """
-    await update.message.reply_text(message)
+    reply(update, message)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.from_user.id not in admins:
         return ConversationHandler.END
     if len(context.args) == 1:
-        player, code = base64.b64decode(context.args[0]).decode().split()
-        if code != keys["code"]:
-            await update.message.reply_text("La carte contient un code erroné.")
+        # stations often scan the same cards again, their tokens are only verified once
+        player = cards.get(context.args[0], lambda: read_card(context.args[0]))
+        if player == None:
+            reply(update, "La carte est illisible ou contient un code erroné.")
             return ConversationHandler.END
 
         player = sanitize_player(player)
 
-        await update.message.reply_text(f"La carte appartient à {player}.")
+        reply(update, f"La carte appartient à {player}.")
 
-        if player not in storage.players:
-            storage.add(player)
-            storage.save()
-            await update.message.reply_text(
+        async with storage_lock:
+            created = player not in storage.players
+            if created:
+                storage.add(player)
+                writer.request()
+        if created:
+            reply(
+                update,
                 f"{player} n'existait pas dans la base de donnée, il vient d'y être ajouté."
             )
 
@@ -209,7 +399,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             keyboard = build_keyboard(player_anims, 2)
             reply_markup = ReplyKeyboardMarkup(keyboard)
 
-            await update.message.reply_text(
+            reply(
+                update,
                 f"{player} est inscrit aux ANIMATIONS suivantes.\n\n> Tu peux choisir une de ces ANIMATIONS ou entrer le nom d'une autre ANIMATION et choisir d'y inscrire le joueur.",
                 reply_markup=reply_markup
             )
@@ -221,7 +412,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
             keyboard = build_keyboard(["Oui", "Non"], 2)
 
-            await update.message.reply_text(
+            reply(
+                update,
                 f"❌ {player} n'est inscrit à aucune ANIMATION ❌\n\n> Veux-tu l'inscrire à une ANIMATION ? Si l'ANIMATION rentrée n'existe pas encore, elle sera créée à la volée.",
                 reply_markup=ReplyKeyboardMarkup(keyboard)
             )
@@ -231,7 +423,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             return CREATE_ANIM
 
     else:
-        await update.message.reply_text("> Entrer le nom du JOUEUR :")
+        reply(update, "> Entrer le nom du JOUEUR :")
         return ANIM
 
 
@@ -249,7 +441,8 @@ async def pick_anim(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
             context.user_data["existing_anim"] = True
 
-            await update.message.reply_text(
+            reply(
+                update,
                 f"{player} est inscrit aux ANIMATIONS suivantes.\n\n> Tu peux choisir une de ces animations ou entrer le nom d'une autre animation et choisir d'y inscrire le joueur.",
                 reply_markup=reply_markup
             )
@@ -260,7 +453,8 @@ async def pick_anim(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
             keyboard = build_keyboard(["Oui", "Non"], 2)
 
-            await update.message.reply_text(
+            reply(
+                update,
                 f"❌ {player} n'est inscrit à aucune ANIMATION ! ❌\n\n> Veux-tu l'inscrire à une animation ? Si l'animation rentrée n'existe pas encore, elle sera créée à la volée.",
                 reply_markup=ReplyKeyboardMarkup(keyboard)
             )
@@ -268,7 +462,17 @@ async def pick_anim(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             return CREATE_ANIM
 
     else:
-        await update.message.reply_text(
+        suggestions = storage.search_players(player, SUGGESTIONS)
+        if len(suggestions) > 0:
+            reply(
+                update,
+                f"❌ {player} n'existe pas encore dans la base de donnée ! ❌\n\n> Tu voulais peut-être dire l'un de ces JOUEURS ? Sinon, tu peux l'ajouter manuellement avec la commande /register.",
+                reply_markup=ReplyKeyboardMarkup(build_keyboard(suggestions, 2))
+            )
+            return ANIM
+
+        reply(
+            update,
             f"❌ {player} n'existe pas encore dans la base de donnée ! ❌\n\nTu peux l'ajouter manuellement avec la commande /register."
         )
 
@@ -278,10 +482,10 @@ async def pick_anim(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def create_anim(update, context):
     if update.message.text.lower() == "oui":
         player = context.user_data["player"]
-        await update.message.reply_text(f"> Entrer le nom de l'ANIMATION à laquelle inscrire {player} :")
+        reply(update, f"> Entrer le nom de l'ANIMATION à laquelle inscrire {player} :")
         return POINTS
     else:
-        await update.message.reply_text(f"👌 {player} n'a été inscrit à aucune ANIMATION 👌")
+        reply(update, f"👌 {player} n'a été inscrit à aucune ANIMATION 👌")
         return ConversationHandler.END
 
 
@@ -289,11 +493,11 @@ async def add_to_anim(update, context):
     if update.message.text.lower() == "oui":
         player = context.user_data["player"]
         anim = context.user_data["anim"]
-        await update.message.reply_text(f"👌 {player} a été inscrit à l'ANIMATION {anim} 👌", reply_markup=ReplyKeyboardRemove())
-        await update.message.reply_text(f"> Entrer les points reçus par {player} à l'ANIMATION {anim} :")
+        reply(update, f"👌 {player} a été inscrit à l'ANIMATION {anim} 👌", reply_markup=ReplyKeyboardRemove())
+        reply(update, f"> Entrer les points reçus par {player} à l'ANIMATION {anim} :")
         return SAVE
     else:
-        await update.message.reply_text(f"{player} n'a pas été inscrit à l'animation. Rien n'a été fait.")
+        reply(update, f"{player} n'a pas été inscrit à l'animation. Rien n'a été fait.")
         return ConversationHandler.END
         
 
@@ -307,22 +511,26 @@ async def enter_points(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             context.user_data["existing_anim"] = False
             keyboard = build_keyboard(["Oui", "Non"], 2)
 
-            await update.message.reply_text(
+            reply(
+                update,
                 f"❌ {player} n'est pas inscrit à l'ANIMATION {anim} ❌\n\n> Veux-tu l'inscrire à l'ANIMATION ?",
                 reply_markup=ReplyKeyboardMarkup(keyboard)
             )
 
             return ADD_TO_ANIM
         else:
-            storage.add(player, anim)
-            storage.save()
+            async with storage_lock:
+                storage.add(player, anim)
+                writer.request()
 
-            await update.message.reply_text(
+            reply(
+                update,
                 f"👌 {player} a été ajouté à l'ANIMATION {anim} 👌",
                 reply_markup=ReplyKeyboardMarkup(keyboard)
             )
     
-    await update.message.reply_text(
+    reply(
+        update,
         f"Entrer les points reçus par {player} à de l'ANIMATION {anim} :",
         reply_markup=ReplyKeyboardRemove()
     )
@@ -334,94 +542,170 @@ async def save(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         points = int(update.message.text.strip())
     except:
-        await update.message.reply_text("❌ Les points doivent être des nombres ❌\n\n> Re-rentrer les points :")
+        reply(update, "❌ Les points doivent être des nombres ❌\n\n> Re-rentrer les points :")
         return SAVE
     player = context.user_data["player"]
     anim = context.user_data["anim"]
-    storage.add(player, anim, points)
-    storage.save()
-    total_points = storage.read(player, anim)
-    await update.message.reply_text(
+    async with storage_lock:
+        storage.add(player, anim, points)
+        history.record(update.effective_user.id, player, anim, points)
+        total_points = storage.read(player, anim)
+    # only confirmed once on disk, along with the other admins' entries of the moment
+    if not await committed(update):
+        return ConversationHandler.END
+    reply(
+        update,
         f"👌 Les résultats ont été sauvés avec succès 👌\n\n[{anim}] {player} - {total_points}pts"
     )
     return ConversationHandler.END
 
 
+def page_keyboard(command: str, arg: str, page: int, n_pages: int) -> InlineKeyboardMarkup:
+    data = lambda p: f"{command}|{p}|{arg}"
+    # Telegram rejects callback data longer than 64 bytes
+    if n_pages <= 1 or len(data(n_pages).encode()) > 64:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀", callback_data=data(page - 1)))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{n_pages}", callback_data=data(page)))
+    if page < n_pages - 1:
+        buttons.append(InlineKeyboardButton("▶", callback_data=data(page + 1)))
+    return InlineKeyboardMarkup([buttons])
+
+
+def render_players(page: int):
+    n_pages = pages(len(storage.players), PAGE_SIZE)
+    page = min(page, n_pages - 1)
+    message = cache.get(("players", page, storage.version), lambda: players_message(storage, page))
+    return message, page_keyboard("players", "", page, n_pages)
+
+
+def render_status(anim: str, page: int, player: str):
+    n_pages = pages(storage.count(anim), STATUS_TOP)
+    page = min(page, n_pages - 1)
+    # the ranking is shared by everyone, only the caller's own rank is built each time
+    message = cache.get(
+        ("status", anim, page, storage.anim_version(anim)),
+        lambda: status_message(storage, anim, page=page)
+    )
+    if page == 0 and anim in storage.anims:
+        message += rank_message(storage, anim, player)
+    return message, page_keyboard("status", anim, page, n_pages)
+
+
 async def list_players(update, context):
-    players = list(storage.players)
-    if len(players):
-        message = "👤 Liste des JOUEURS 👤\n\n"
-        message += "\n".join(",  ".join(line) for line in zip(players[::2], players[1::2]))
-        if len(players) % 2 == 1:
-            message += f"\n{players[-1]}"
-    else:
-        message = "❌ Aucun JOUEUR n'a encore été enregistrée ! ❌"
-    await update.message.reply_text(message)
+    message, keyboard = render_players(0)
+    reply(update, message, reply_markup=keyboard, priority=READ)
 
 
 async def list_anims(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    anims = list(set(a for a_p in storage.storage.values() for a in a_p.keys()))
-    if len(anims):
-        message = "🏆 Liste des ANIMATIONS 🏆\n\n"
-        message += "\n".join(",  ".join(line) for line in zip(anims[::2], anims[1::2]))
-        if len(anims) % 2 == 1:
-            if len(anims) > 1:
-                message += "\n"
-            message += anims[0]
-    else:
-        message = "❌ Aucune ANIMATION n'a encore été enregistrée ❌"
-    await update.message.reply_text(message)
+    message = cache.get(("anims", storage.version), lambda: anims_message(storage))
+    reply(update, message, priority=READ)
 
 
 async def status(update, context):
     if len(context.args) > 0:
         anim = sanitize_anim(' '.join(context.args))
-        if anim not in storage.anims:
-            message = "❌ L'ANIMATION n'a pas encore été enregistrée ❌"
-        else:
-            players_points = list(storage.read(anim=anim).items())
-            players_points.sort(key=itemgetter(1), reverse=True)
-            ranking = [f"{idx + 1}. {player} - {points}pts" for idx, (player, points) in enumerate(players_points)]
-            medals = ["🥇",  "🥈", "🥉"]
-            fancy_ranking = [f"{rank} {medal}" for medal, rank in zip(medals, ranking[:3])] + ranking[3:]
-            message = f"🧮 [{anim}] Classement 🧮\n\n"
-            message += "\n".join(fancy_ranking)
+        # players are registered under their Telegram username
+        player = sanitize_player(update.message.from_user.username or "")
+        message, keyboard = render_status(anim, 0, player)
     else:
-        message = "❌ Il faut spécifier une ANIMATION ❌"
-    await update.message.reply_text(message)
+        message, keyboard = "❌ Il faut spécifier une ANIMATION ❌", None
+    reply(update, message, reply_markup=keyboard, priority=READ)
+
+
+async def global_top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        n = int(context.args[0]) if len(context.args) > 0 else STATUS_TOP
+    except ValueError:
+        reply(update, "❌ Le nombre de JOUEURS doit être un nombre ❌", priority=READ)
+        return
+    n = max(1, min(n, TOP_MAX))
+    player = sanitize_player(update.message.from_user.username or "")
+    message = cache.get(("top", n, storage.version), lambda: top_message(storage, n))
+    message += total_rank_message(storage, player, n)
+    reply(update, message, priority=READ)
+
+
+async def turn_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    command, page, arg = query.data.split("|", 2)
+    if command == "players":
+        message, keyboard = render_players(int(page))
+    else:
+        message, keyboard = render_status(arg, int(page), sanitize_player(query.from_user.username or ""))
+    await query.answer()
+    try:
+        await query.edit_message_text(message, reply_markup=keyboard)
+    except BadRequest:
+        # the page didn't change since it was displayed
+        pass
+
+
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # `@bot <name>` in any chat, so that names can be picked instead of typed during a command
+    query = update.inline_query
+    text = query.query.strip()
+    if text == "":
+        await query.answer([], cache_time=5)
+        return
+    players = storage.search_players(sanitize_player(text), INLINE_RESULTS)
+    anims = storage.search_anims(sanitize_anim(text), INLINE_RESULTS)
+    results = [
+        InlineQueryResultArticle(f"{kind}{idx}", name, InputTextMessageContent(name), description=description)
+        for kind, description, names in (("p", "JOUEUR", players), ("a", "ANIMATION", anims))
+        for idx, name in enumerate(names)
+    ]
+    await query.answer(results, cache_time=5)
 
 
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(context.args) > 0:
         player = sanitize_player(context.args[0])
-        if player not in storage.players:
-            message = f"❌ {player} n'existe pas encore dans la base de donnée ❌"
+        if len(context.args) > 1:
+            anim = sanitize_anim(' '.join(context.args[1:]))
         else:
-            if len(context.args) > 1:
-                anim = sanitize_anim(' '.join(context.args[1:]))
-                if anim not in storage.anims:
-                    message = f"❌ L'ANIMATION {anim} n'existe pas ❌"
-                elif anim not in storage.read(player):
-                    message = f"❌ {player} n'est pas inscrit à l'ANIMATION {anim} ❌"
-                else:
-                    points = storage.read(player, anim)
-                    message = f"[{anim}] {player} - {points}pts"
-            else:
-                anims_points = list(storage.read(player).items())
-                if len(anims_points):
-                    message = f"🧮 ANIMATIONS et POINTS de {player} 🧮\n\n"
-                    message += "\n".join(f"[{a}] {points}pts" for a, points in anims_points)
-                else:
-                    message = f"❌ {player} n'est inscrit à aucune ANIMATION ❌"
+            anim = None
+        message = cache.get(("info", player, anim, storage.version), lambda: info_message(storage, player, anim))
     else:
         message = "❌ Il faut spécifier un JOUEUR et (éventuellement) une ANIMATION ❌"
-    await update.message.reply_text(message)
+    reply(update, message, priority=READ)
+
+
+async def teams(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    anim = sanitize_anim(' '.join(context.args)) if len(context.args) > 0 else None
+    message = cache.get(("teams", anim, storage.version), lambda: teams_message(storage, anim))
+    reply(update, message, priority=READ)
+
+
+async def set_team(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id not in admins:
+        return
+    if len(context.args) == 0:
+        reply(update, "❌ Il faut spécifier un JOUEUR et (éventuellement) une ÉQUIPE ❌")
+        return
+    player = sanitize_player(context.args[0])
+    team = sanitize_team(' '.join(context.args[1:])) or None
+    async with storage_lock:
+        storage.set_team(player, team)
+        # only the SQLite backend waits for a flush, the others write the teams right away
+        dirty = storage.dirty
+    if dirty and not await committed(update):
+        return
+    if team == None:
+        message = f"👥 {player} ne fait plus partie d'aucune équipe 👥"
+    else:
+        message = f"👥 {player} fait maintenant partie de l'équipe {team} 👥"
+    if player not in storage.players:
+        message += f"\n\n{player} n'est pas encore enregistré, ses points compteront dès son inscription."
+    reply(update, message)
 
 
 async def register_player(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.from_user.id not in admins:
         return ConversationHandler.END
-    await update.message.reply_text("Entrer le nom du JOUEUR :")
+    reply(update, "Entrer le nom du JOUEUR :")
 
     return ADD_ANIM
 
@@ -430,16 +714,34 @@ async def add_anim(update, context):
     player = sanitize_player(update.message.text)
     context.user_data["register"] = player
 
+    # a new name close to existing ones is only created once it was entered twice in a row
+    if player not in storage.players and context.user_data.pop("register_unknown", None) != player:
+        suggestions = storage.search_players(player, SUGGESTIONS)
+        if len(suggestions) > 0:
+            context.user_data["register_unknown"] = player
+            reply(
+                update,
+                f"❓ {player} n'existe pas encore dans la base de donnée ❓\n\n> Tu voulais peut-être dire l'un de ces JOUEURS ? Renvoie {player} pour le créer quand même.",
+                reply_markup=ReplyKeyboardMarkup(build_keyboard(suggestions + [player], 2))
+            )
+            return ADD_ANIM
+
     keyboard = build_keyboard(["Oui", "Non"], 2)
-    if player not in storage.players:
-        storage.add(player)
-        storage.save()
-        await update.message.reply_text(
+    async with storage_lock:
+        created = player not in storage.players
+        if created:
+            storage.add(player)
+    if created and not await committed(update):
+        return ConversationHandler.END
+    if created:
+        reply(
+            update,
             f"👌 Le joueur {player} a été ajouté à la base de donnée avec succès 👌\n\n> Veux-tu l'inscrire à une animation par la même occasion ? L'animation n'a pas besoin de déjà exister.",
             reply_markup=ReplyKeyboardMarkup(keyboard)
         )
     else:
-        await update.message.reply_text(
+        reply(
+            update,
             f"👌 Le joueur {player} existe déjà 👌\n\n> Veux-tu l'inscrire à une animation ? L'animation n'a pas besoin d'exister.",
             reply_markup=ReplyKeyboardMarkup(keyboard)
         )
@@ -449,13 +751,15 @@ async def add_anim(update, context):
 
 async def add_anim_reply(update, context):
     if update.message.text.lower() == "oui":
-        await update.message.reply_text(
+        reply(
+            update,
             "> Entrer le nom de l'ANIMATION :",
             reply_markup=ReplyKeyboardRemove()
         )
         return REGISTER_ANIM
     else:
-        await update.message.reply_text(
+        reply(
+            update,
             f"👌 Le JOUEUR n'a été ajouté à aucune ANIMATION. Il te faudra rappeler cette commande afin de pouvoir l'inscrire à une ANIMATION 👌",
             reply_markup=ReplyKeyboardRemove()
         )
@@ -465,10 +769,13 @@ async def add_anim_reply(update, context):
 async def register_anim(update, context):
     anim = sanitize_anim(update.message.text)
     player = context.user_data["register"]
-    storage.add(player, anim)
-    storage.save()
+    async with storage_lock:
+        storage.add(player, anim)
+    if not await committed(update):
+        return ConversationHandler.END
 
-    await update.message.reply_text(
+    reply(
+        update,
         f"👌 {player} a été ajouté à l'ANIMATION {anim} avec succès ! 👌\n\nTu peux maintenant lui ajouter des points avec la commande /start.",
         reply_markup=ReplyKeyboardRemove()
     )
@@ -480,7 +787,8 @@ async def remove(update, context):
     if update.message.from_user.id not in admins:
         return ConversationHandler.END
     keyboard = build_keyboard(["Oui", "Non"], 2)
-    await update.message.reply_text(
+    reply(
+        update,
         """
 🚨 ATTENTION 🚨
 Cette commande est dangereuse ! Continue seulement si tu sais ce que tu fais. Contacter Hugo (@billjobs42) ou Stache (@Stache) en cas de besoin.
@@ -495,14 +803,16 @@ Cette commande est dangereuse ! Continue seulement si tu sais ce que tu fais. Co
 async def remove_proceed(update, context):
     if update.message.text.lower() == "oui":
         keyboard = build_keyboard(["Joueur", "Inscription"], 2)
-        await update.message.reply_text(
+        reply(
+            update,
             "> Qu'est-ce que tu voudrais supprimer ?",
             reply_markup=ReplyKeyboardMarkup(keyboard)
         )
         return REMOVE_REPLY
 
     else:
-        await update.message.reply_text(
+        reply(
+            update,
             "👌 Annulation de la suppresion 👌",
             reply_markup=ReplyKeyboardRemove()
         )
@@ -510,10 +820,11 @@ async def remove_proceed(update, context):
 
 
 async def remove_reply(update, context):
-    reply = update.message.text.lower()
+    answer = update.message.text.lower()
     
-    if reply == "joueur":
-        await update.message.reply_text(
+    if answer == "joueur":
+        reply(
+            update,
             """
 🚨 ATTENTION 🚨
 Tu t'apprêtes à supprimer un JOUEUR de la base de donnée. Ça aura pour effet de supprimer tous ses scores à toutes ses ANIMATIONS.
@@ -523,8 +834,9 @@ Tu t'apprêtes à supprimer un JOUEUR de la base de donnée. Ça aura pour effet
             reply_markup=ReplyKeyboardRemove()
         )
         return REMOVE_PLAYER
-    elif reply == "inscription":
-        await update.message.reply_text(
+    elif answer == "inscription":
+        reply(
+            update,
             """
 🚨 ATTENTION 🚨
 Tu t'apprêtes à désinscrire un JOUEUR d'une ANIMATION. Ça aura pour effet de supprimer ses points obtenus à l'ANIMATION.
@@ -535,7 +847,7 @@ Tu t'apprêtes à désinscrire un JOUEUR d'une ANIMATION. Ça aura pour effet de
         )
         return REMOVE_ANIM_1
     else:
-        await update.message.reply_text("❌ Réponse invalide ❌", reply_markup=ReplyKeyboardRemove())
+        reply(update, "❌ Réponse invalide ❌", reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
 
 
@@ -543,15 +855,25 @@ async def remove_anim_reply_player(update, context):
     player = sanitize_player(update.message.text)
 
     if player not in storage.players:
-        await update.message.reply_text(
+        suggestions = storage.search_players(player, SUGGESTIONS)
+        if len(suggestions) > 0:
+            reply(
+                update,
+                f"❌ {player} n'existe pas encore dans la base de donnée ❌\n\n> Tu voulais peut-être dire l'un de ces JOUEURS ?",
+                reply_markup=ReplyKeyboardMarkup(build_keyboard(suggestions, 2))
+            )
+            return REMOVE_ANIM_1
+        reply(
+            update,
             f"❌ {player} n'existe pas encore dans la base de donnée. Rien n'a été fait ❌"
         )
         return ConversationHandler.END
 
     context.user_data['remove'] = player
 
-    keyboard = build_keyboard(list(storage.read(player=player).keys()))
-    await update.message.reply_text(
+    keyboard = build_keyboard(list(storage.read(player=player).keys()), 2)
+    reply(
+        update,
         f"> De quelle ANIMATION faut-il désincrire {player} ?",
         reply_markup=ReplyKeyboardMarkup(keyboard)
     )
@@ -562,14 +884,22 @@ async def remove_anim_reply_anim(update, context):
     player = context.user_data['remove']
     anim = sanitize_anim(update.message.text)
 
-    if anim not in storage.anims:
-        await update.message.reply_text(
+    async with storage_lock:
+        removed = player in storage.players and anim in storage.read(player)
+        if removed:
+            history.record(update.effective_user.id, player, anim, -storage.read(player, anim), removed=True)
+            storage.remove(player, anim)
+    if removed and not await committed(update):
+        return ConversationHandler.END
+    if not removed:
+        reply(
+            update,
             f"❌ {player} n'est pas encore inscrit à l'ANIMATION {anim}. Rien a été fait ❌",
             reply_markup=ReplyKeyboardRemove()
         )
     else:
-        storage.remove(player, anim)
-        await update.message.reply_text(
+        reply(
+            update,
             f"👌 {player} a été désinscrit de l'ANIMATION {anim} avec succès 👌",
             reply_markup=ReplyKeyboardRemove()
         )
@@ -580,22 +910,212 @@ async def remove_anim_reply_anim(update, context):
 async def remove_player_reply(update, context):
     player = sanitize_player(update.message.text)
 
-    if player not in storage.players:
-        await update.message.reply_text(
+    async with storage_lock:
+        removed = player in storage.players
+        if removed:
+            for anim, points in storage.read(player).items():
+                history.record(update.effective_user.id, player, anim, -points, removed=True)
+            storage.remove(player)
+    if removed and not await committed(update):
+        return ConversationHandler.END
+    suggestions = [] if removed else storage.search_players(player, SUGGESTIONS)
+    if len(suggestions) > 0:
+        reply(
+            update,
+            f"❌ {player} n'existe pas encore dans la base de donnée ❌\n\n> Tu voulais peut-être dire l'un de ces JOUEURS ?",
+            reply_markup=ReplyKeyboardMarkup(build_keyboard(suggestions, 2))
+        )
+        return REMOVE_PLAYER
+    if not removed:
+        reply(
+            update,
             f"❌ {player} n'existe pas encore dans la base de donnée. Rien n'a été fait ❌"
         )
     else:
-        storage.remove(player)
-        storage.save()
-        await update.message.reply_text(
-            f"👌 {player} a été supprimé de la base de donnée avec succès 👌"
+        reply(
+            update,
+            f"👌 {player} a été supprimé de la base de donnée avec succès 👌",
+            reply_markup=ReplyKeyboardRemove()
         )
 
     return ConversationHandler.END
 
 
+async def apply_bulk(update: Update, lines: List[str]) -> List[str]:
+    async with storage_lock:
+        summary = apply_bulk_locked(lines, update.effective_user.id)
+    # all the lines are persisted together, the summary says what was recorded even if they could not be
+    await committed(update)
+    return summary
+
+
+def apply_bulk_locked(lines: List[str], admin: int) -> List[str]:
+    summary = []
+    for idx, line in enumerate(lines):
+        if line.strip() == "":
+            continue
+        data = line.split(",")
+        if len(data) != 3:
+            summary.append(f"❌ {idx + 1}. {line} : il faut <joueur>,<animation>,<points>")
+            continue
+        player = sanitize_player(data[0])
+        anim = sanitize_anim(data[1])
+        if player == "" or anim == "":
+            summary.append(f"❌ {idx + 1}. {line} : JOUEUR ou ANIMATION vide")
+            continue
+        try:
+            points = int(data[2].strip())
+        except ValueError:
+            summary.append(f"❌ {idx + 1}. {line} : les points doivent être des nombres")
+            continue
+        storage.add(player, anim, points)
+        history.record(admin, player, anim, points)
+        summary.append(f"👌 {idx + 1}. [{anim}] {player} {points:+d}pts - {storage.read(player, anim)}pts")
+    return summary
+
+
+async def send_bulk_summary(update: Update, context: ContextTypes.DEFAULT_TYPE, summary: List[str]) -> None:
+    message = "\n".join(summary)
+    if len(message) <= MAX_LENGTH:
+        reply(update, message)
+        return
+
+    # too long for a message: the counts and the rejected lines, the full report as a document
+    rejected = [line for line in summary if line.startswith("❌")]
+    message = f"📋 {len(summary) - len(rejected)} lignes acceptées, {len(rejected)} refusées 📋"
+    if len(rejected) > 0:
+        message += "\n\n" + "\n".join(rejected)
+    reply(update, message)
+    await send_document(update.effective_chat.id, "\n".join(summary).encode("utf-8"), "bulk.txt", "📋 Rapport complet")
+
+
+async def bulk(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if update.message.from_user.id not in admins:
+        return ConversationHandler.END
+    data = update.message.text.split(maxsplit=1)
+    if len(data) > 1:
+        await send_bulk_summary(update, context, await apply_bulk(update, data[1].splitlines()))
+        return ConversationHandler.END
+
+    reply(
+        update,
+        "> Colle les lignes <joueur>,<animation>,<points> ou envoie un fichier CSV :"
+    )
+    return BULK
+
+
+async def bulk_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await send_bulk_summary(update, context, await apply_bulk(update, update.message.text.splitlines()))
+    return ConversationHandler.END
+
+
+async def bulk_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    document = await update.message.document.get_file()
+    try:
+        lines = (await document.download_as_bytearray()).decode("utf-8-sig").splitlines()
+    except UnicodeDecodeError:
+        reply(update, "❌ Le fichier doit être un CSV encodé en UTF-8 ❌")
+        return ConversationHandler.END
+    await send_bulk_summary(update, context, await apply_bulk(update, lines))
+    return ConversationHandler.END
+
+
+async def recent(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id not in admins:
+        return
+    try:
+        minutes = float(context.args[0]) if len(context.args) > 0 else 15
+    except ValueError:
+        reply(update, "❌ Il faut spécifier un nombre de minutes et (éventuellement) une ANIMATION ❌")
+        return
+    anim = sanitize_anim(' '.join(context.args[1:])) if len(context.args) > 1 else None
+    reply(update, recent_message(history, minutes, anim))
+
+
+def undoable(event: Event) -> bool:
+    # entries are undone on the enrollment they changed, unenrollments by enrolling the player again
+    enrolled = event.player in storage.players and event.anim in storage.read(event.player)
+    return enrolled != event.removed
+
+
+async def undo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id not in admins:
+        return
+    admin = update.effective_user.id
+    async with storage_lock:
+        idx = history.last(admin, undoable)
+        if idx != None:
+            event = history.events[idx]
+            storage.add(event.player, event.anim, -event.delta)
+            history.record(admin, event.player, event.anim, -event.delta, undoes=idx)
+            total_points = storage.read(event.player, event.anim)
+    if idx != None and not await committed(update):
+        return
+    if idx == None:
+        reply(update, "❌ Tu n'as aucune entrée à annuler ❌")
+    elif event.removed:
+        reply(
+            update,
+            f"↩️ {event.player} a été réinscrit à l'ANIMATION {event.anim} ↩️\n\n[{event.anim}] {event.player} - {total_points}pts"
+        )
+    else:
+        reply(
+            update,
+            f"↩️ L'entrée {event.delta:+d}pts a été annulée ↩️\n\n[{event.anim}] {event.player} - {total_points}pts"
+        )
+
+
+def export_sqlite(fmt: str, anim: str, compress: bool):
+    # SQLite connections can't be shared between threads, the export reads what was committed through its own
+    reader = SqliteStorage(storage.path, readonly=True, weights=weights)
+    try:
+        return export_file(rankings(reader, anim), fmt, compress)
+    finally:
+        reader.db.close()
+
+
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id not in admins:
+        return
+    args = list(context.args)
+    fmt, compress = "csv", False
+    if len(args) > 0 and args[0].lower().removesuffix(".gz") in FORMATS:
+        compress = args[0].lower().endswith(".gz")
+        fmt = args.pop(0).lower().removesuffix(".gz")
+    anim = sanitize_anim(' '.join(args)) if len(args) > 0 else None
+    if anim != None and anim not in storage.anims:
+        reply(update, f"❌ L'ANIMATION {anim} n'existe pas ❌" + did_you_mean(storage.search_anims(anim, SUGGESTIONS)))
+        return
+
+    # the file is written in a worker thread, the other users are answered in the meantime
+    loop = asyncio.get_running_loop()
+    if isinstance(storage, SqliteStorage):
+        try:
+            await writer.commit()
+        except Exception:
+            # the export only reads what was committed
+            reply(update, "❌ Les dernières entrées n'ont pas pu être sauvées, l'export n'a pas été fait ❌")
+            return
+        file = await loop.run_in_executor(None, export_sqlite, fmt, anim, compress)
+    else:
+        # the rankings are only copied under the lock, entering points waits for that alone
+        async with storage_lock:
+            copy = await loop.run_in_executor(None, rankings, storage, anim)
+        file = await loop.run_in_executor(None, export_file, copy, fmt, compress)
+
+    # the upload is built from the whole content, which is why it can be gzipped
+    with file:
+        document = await loop.run_in_executor(None, file.read)
+
+    filename = time.strftime("classement-%Y%m%d-%H%M%S") + f".{fmt}" + (".gz" if compress else "")
+    caption = f"📦 Classement {'de ' + anim if anim != None else 'complet'}"
+    if not await send_document(update.effective_chat.id, document, filename, caption):
+        reply(update, "❌ L'export n'a pas pu être envoyé ❌")
+
+
 async def cancel(update, context):
-    await update.message.reply_text(
+    reply(
+        update,
         "😐 Tu as entré une commande alors qu'une autre était en cours. La commande précédente a donc été interrompue 😐",
         reply_markup=ReplyKeyboardRemove()
     )
@@ -608,11 +1128,90 @@ async def debug(update, context):
     name = user.first_name or "" + " " + user.last_name or ""
     username = user.username
     logger.info(f"\nCHAT ID: {user_id}\nNAME: {name}\nUSERNAME: @{username}")
-    await update.message.reply_text("success", reply_markup=ReplyKeyboardRemove())
+    logger.info(f"OUTBOX: {outbox.stats()}")
+    reply(update, "success", reply_markup=ReplyKeyboardRemove())
 
 
-def main() -> None:
-    application = Application.builder().token(keys["token"]).build()
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id not in admins:
+        return
+    outbox_stats = outbox.stats()
+    message = "📈 Statistiques 📈\n\n"
+    message += metrics.report()
+    message += (
+        f"\n\nÉcritures : {writer.commits} confirmées en {writer.flushes} sauvegardes"
+        f"\nCache : {cache.hits} hits, {cache.misses} misses ({cache.hit_rate:.0%})"
+        f"\nCartes : {cards.hits} hits, {cards.misses} vérifiées ({cards.hit_rate:.0%})"
+        f"\nEnvois : {outbox_stats['sent']} envoyés, {outbox_stats['depth']} en attente, "
+        f"{outbox_stats['merged']} fusionnés, {outbox_stats['errors']} erreurs, "
+        f"latence p50 {outbox_stats['latency_p50'] * 1000:.0f}ms, max {outbox_stats['latency_max'] * 1000:.0f}ms"
+    )
+    if broadcaster != None:
+        message += (
+            f"\nCanal : {broadcaster.edits} modifications, {broadcaster.skipped} inchangés, "
+            f"{broadcaster.errors} erreurs"
+        )
+    reply(update, message)
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id not in admins:
+        return
+    try:
+        seconds = float(context.args[0]) if len(context.args) > 0 else 30
+        updates = int(context.args[1]) if len(context.args) > 1 else None
+    except ValueError:
+        reply(update, "❌ Il faut spécifier un nombre de secondes et (éventuellement) de commandes ❌")
+        return
+    chat_id = update.effective_chat.id
+
+    async def send_summary(summary: str, path: str) -> None:
+        filename = os.path.basename(path)[:-len(".prof")] + ".txt"
+        await send_document(chat_id, summary.encode("utf-8"), filename, f"🔬 Profil complet : {path}")
+
+    if not profiler.start(seconds, updates, send_summary):
+        reply(update, "❌ Un profilage est déjà en cours ❌")
+        return
+    message = f"🔬 Profilage lancé pour {seconds:g}s"
+    if updates != None:
+        message += f" ou {updates} commandes"
+    reply(update, message)
+
+
+async def post_init(application: Application) -> None:
+    await writer.start(application)
+    await outbox.start(application.bot)
+    # `kill -USR1 <pid>` profiles the bot for 30 seconds, the summary is only written to disk
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: profiler.start(30))
+    if "metrics_port" in config:
+        await metrics.serve(config.get("metrics_host", "127.0.0.1"), int(config["metrics_port"]))
+
+
+async def post_shutdown(application: Application) -> None:
+    profiler.stop()
+    await metrics.close()
+    history.close()
+    await writer.stop(application)
+
+
+def build_application(builder=None) -> Application:
+    """
+    The bot with all its handlers, `builder` being given to talk to something else than Telegram.
+    Its application class must derive from OutboxApplication, for the replies to be sent when stopping.
+    """
+    if builder == None:
+        builder = Application.builder().application_class(OutboxApplication).token(keys["token"])
+    if persistence != None:
+        builder = builder.persistence(persistence)
+    application = (
+        builder
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(int(config.get("concurrent_updates", 0)))
+        .build()
+    )
+    application.outbox = outbox
 
     application.add_handler(CommandHandler("help", help), 1)
 
@@ -620,6 +1219,8 @@ def main() -> None:
 
     points_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
+        name="points",
+        persistent=persistence != None,
         states={
             ANIM: [MessageHandler(filters=conv_filter, callback=pick_anim)],
             CREATE_ANIM: [MessageHandler(filters=conv_filter, callback=create_anim)],
@@ -633,6 +1234,8 @@ def main() -> None:
 
     register_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("register", register_player)],
+        name="register",
+        persistent=persistence != None,
         states={
             ADD_ANIM: [MessageHandler(filters=conv_filter, callback=add_anim)],
             ADD_ANIM_REPLY: [MessageHandler(filters=conv_filter, callback=add_anim_reply)],
@@ -644,6 +1247,8 @@ def main() -> None:
 
     remove_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("remove", remove)],
+        name="remove",
+        persistent=persistence != None,
         states={
             REMOVE_PROCEED: [MessageHandler(filters=conv_filter, callback=remove_proceed)],
             REMOVE_REPLY: [MessageHandler(filters=conv_filter, callback=remove_reply)],
@@ -655,14 +1260,64 @@ def main() -> None:
     )
     application.add_handler(remove_conv_handler, 2)
 
+    bulk_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("bulk", bulk)],
+        name="bulk",
+        persistent=persistence != None,
+        states={
+            BULK: [
+                MessageHandler(filters=conv_filter, callback=bulk_text),
+                MessageHandler(filters=filters.Document.ALL, callback=bulk_document)
+            ]
+        },
+        fallbacks=[MessageHandler(filters=filters.COMMAND, callback=cancel)]
+    )
+    application.add_handler(bulk_conv_handler, 4)
+
     application.add_handler(CommandHandler("players", list_players), 3)
     application.add_handler(CommandHandler("anims", list_anims), 3)
     application.add_handler(CommandHandler("info", info), 3)
     application.add_handler(CommandHandler("status", status), 3)
+    application.add_handler(CommandHandler("top", global_top), 3)
+    application.add_handler(CommandHandler("teams", teams), 3)
+    application.add_handler(CallbackQueryHandler(turn_page, pattern=r"^(players|status)\|"), 3)
+    application.add_handler(InlineQueryHandler(inline_search), 3)
 
     application.add_handler(CommandHandler("debug", debug), 3)
+    application.add_handler(CommandHandler("stats", stats), 3)
+    application.add_handler(CommandHandler("recent", recent), 3)
+    application.add_handler(CommandHandler("undo", undo), 3)
+    application.add_handler(CommandHandler("profile", profile), 3)
+    application.add_handler(CommandHandler("export", export), 3)
+    application.add_handler(CommandHandler("team", set_team), 3)
+
+    if broadcaster != None:
+        if application.job_queue == None:
+            logger.warning('The channel is not updated, the job queue needs "python-telegram-bot[job-queue]"')
+        else:
+            application.job_queue.run_repeating(broadcaster.push, float(config.get("channel_interval", 30)), first=1)
+
+    metrics.instrument(application)
+    return application
 
-    application.run_polling()
+
+def main() -> None:
+    if "webhook_url" in config and importlib.util.find_spec("tornado") == None:
+        # PTB only finds out once the bot is initialized, with a less helpful message
+        raise SystemExit('webhook_url needs "python-telegram-bot[webhooks]": pip install "python-telegram-bot[webhooks]==20.0a6"')
+    application = build_application()
+
+    if "webhook_url" in config:
+        # Telegram pushes updates to `webhook_url`, which must reach the local listener through a reverse proxy
+        application.run_webhook(
+            listen=config.get("webhook_listen", "127.0.0.1"),
+            port=int(config.get("webhook_port", 8443)),
+            url_path=config.get("webhook_path", ""),
+            webhook_url=config["webhook_url"],
+            secret_token=config.get("webhook_secret")
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from itertools import count
+from typing import Tuple
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.request import BaseRequest, RequestData
+
+from bench_storage import generate
+from outbox import OutboxApplication
+from tokens import sign
+
+TOKEN = "123456:loadtest"
+CODE = "loadtest"
+SECRET = "loadtest-cards"
+BOT_ID = 123456
+# runs after every handler of an update, to time its dispatch
+DONE_GROUP = 1000
+
+
+class FakeRequest(BaseRequest):
+    """
+    Stands in for the Bot API: every call is answered locally, and the messages
+    sent by the bot wake up the simulated users waiting for them.
+    """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.message_ids = count(1)
+        # chat id -> futures resolved with the text of the next message sent there
+        self.waiters = {}
+
+
+    async def initialize(self) -> None:
+        pass
+
+
+    async def shutdown(self) -> None:
+        pass
+
+
+    def next_message(self, chat_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(chat_id, []).append(future)
+        return future
+
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: RequestData=None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None
+    ) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data != None else {}
+        if endpoint == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "ICeLAN", "username": "icelan_bot"}
+        elif endpoint == "sendMessage":
+            chat_id = int(params["chat_id"])
+            result = {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params["text"]
+            }
+            for future in self.waiters.pop(chat_id, ()):
+                if not future.done():
+                    future.set_result(params["text"])
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+class TimedApplication(OutboxApplication):
+    """Application timing its persistence updates, copies of the data included."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.persistence_seconds = 0
+
+
+    async def update_persistence(self) -> None:
+        start = time.perf_counter()
+        await super().update_persistence()
+        self.persistence_seconds += time.perf_counter() - start
+
+
+def summary(latencies: list) -> dict:
+    latencies = sorted(latencies)
+    if len(latencies) == 0:
+        return {"n": 0}
+    return {
+        "n": len(latencies),
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) * 99 // 100, len(latencies) - 1)] * 1000,
+        "max_ms": latencies[-1] * 1000
+    }
+
+
+class Simulation:
+    """Simulated users, each sending a message and waiting for the bot's reply before the next one."""
+
+    def __init__(self, bot, application: Application, request: FakeRequest, args, rng: random.Random):
+        self.bot = bot
+        self.application = application
+        self.request = request
+        self.args = args
+        self.rng = rng
+        self.update_ids = count(1)
+        self.message_ids = count(1)
+        # update id -> future resolved once every handler went through it
+        self.dispatching = {}
+        # step -> seconds until the first reply, and until the update was handled
+        self.latencies = {}
+        self.dispatch = {}
+        self.timeouts = 0
+        application.add_handler(TypeHandler(Update, self.dispatched), DONE_GROUP)
+
+
+    async def dispatched(self, update: Update, context) -> None:
+        future = self.dispatching.pop(update.update_id, None)
+        if future != None:
+            future.set_result(time.perf_counter())
+
+
+    def update(self, user_id: int, text: str) -> Update:
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            # simulated users are registered under their username, like real players
+            "from": {"id": user_id, "is_bot": False, "first_name": f"player{user_id}", "username": f"player{user_id}"},
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": next(self.update_ids), "message": message}, self.application.bot)
+
+
+    async def step(self, name: str, user_id: int, text: str) -> str:
+        """Send `text` from `user_id`, and return the first reply."""
+        update = self.update(user_id, text)
+        dispatched = self.dispatching[update.update_id] = asyncio.get_running_loop().create_future()
+        replied = self.request.next_message(user_id)
+        start = time.perf_counter()
+        await self.application.update_queue.put(update)
+        self.dispatch.setdefault(name, []).append(await dispatched - start)
+        try:
+            reply = await asyncio.wait_for(replied, self.args.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return ""
+        self.latencies.setdefault(name, []).append(time.perf_counter() - start)
+        # the other messages of the step go out before the next one
+        while user_id in self.bot.outbox.queues:
+            try:
+                await asyncio.wait_for(self.request.next_message(user_id), self.args.timeout)
+            except asyncio.TimeoutError:
+                break
+        return reply
+
+
+    async def think(self) -> None:
+        if self.args.think > 0:
+            await asyncio.sleep(self.rng.uniform(0, self.args.think))
+
+
+    async def player(self, user_id: int) -> None:
+        """Checks the rankings and their own points."""
+        anims = list(self.bot.storage.anims)
+        for _ in range(self.args.steps):
+            await self.think()
+            if self.rng.random() < 0.5:
+                await self.step("status", user_id, f"/status {self.rng.choice(anims)}")
+            else:
+                await self.step("info", user_id, f"/info player{self.rng.randrange(self.args.players)}")
+
+
+    async def admin(self, user_id: int) -> None:
+        """Scans player cards and enters their points in one of their anims."""
+        for _ in range(self.args.steps):
+            await self.think()
+            player = f"player{self.rng.randrange(self.args.players)}"
+            card = sign(player, SECRET.encode("utf-8"))
+            await self.step("start", user_id, f"/start {card}")
+            anim = self.rng.choice(list(self.bot.storage.read(player)))
+            await self.step("anim", user_id, anim)
+            await self.step("save", user_id, str(self.rng.randrange(1, 100)))
+
+
+    async def run(self) -> float:
+        # admins come first, their ids are listed in .admins
+        users = [self.admin(user_id) for user_id in range(1, self.args.admins + 1)]
+        users += [self.player(user_id) for user_id in range(self.args.admins + 1, self.args.users + 1)]
+        start = time.perf_counter()
+        await asyncio.gather(*users)
+        return time.perf_counter() - start
+
+
+async def simulate(bot, args) -> dict:
+    request = FakeRequest()
+    application = bot.build_application(
+        Application.builder().application_class(TimedApplication).token(TOKEN)
+        .request(request).get_updates_request(FakeRequest())
+    )
+    simulation = Simulation(bot, application, request, args, random.Random(args.seed))
+    version = bot.storage.version
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    elapsed = await simulation.run()
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+    steps = sum(len(latencies) for latencies in simulation.dispatch.values())
+    if bot.persistence != None:
+        persistence = bot.persistence.stats()
+        persistence["update_seconds"] = application.persistence_seconds
+        persistence["per_update_us"] = application.persistence_seconds / steps * 1e6
+    else:
+        persistence = None
+    return {
+        "users": args.users,
+        "admins": args.admins,
+        "steps": steps,
+        "duration_s": elapsed,
+        "throughput_per_s": steps / elapsed,
+        "timeouts": simulation.timeouts,
+        "reply_latency": {name: summary(latencies) for name, latencies in simulation.latencies.items()},
+        "dispatch_latency": {name: summary(latencies) for name, latencies in simulation.dispatch.items()},
+        "storage": {
+            "changes": bot.storage.version - version,
+            "commits": bot.writer.commits,
+            "flushes": bot.writer.flushes
+        },
+        "outbox": bot.outbox.stats(),
+        "persistence": persistence,
+        "bot_api_calls": dict(request.calls)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Drive the bot's handlers with simulated users, offline, results are printed as JSON"
+    )
+    parser.add_argument("--users", type=int, default=1000, help="simulated users, admins included")
+    parser.add_argument("--admins", type=int, default=20, help="users entering points through /start")
+    parser.add_argument("--steps", type=int, default=10, help="commands, or /start conversations, per user")
+    parser.add_argument("--think", type=float, default=0, help="longest random pause between two steps, in seconds")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for a reply")
+    parser.add_argument("--players", type=int, default=10000, help="players in the generated storage")
+    parser.add_argument("--anims", type=int, default=50, help="anims in the generated storage")
+    parser.add_argument("--enrollments", type=int, default=3, help="anims joined by each player")
+    parser.add_argument(
+        "--config", action="append", default=[], metavar="KEY,VALUE",
+        help=".config line for the bot, e.g. journal,1 (the flood limits are lifted unless given)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="file to write the results to, instead of stdout")
+
+    args = parser.parse_args()
+
+    config = {"concurrent_updates": "64", "chat_rate": "1000", "global_rate": "1000000"}
+    config.update(line.split(",", 1) for line in args.config)
+
+    # the bot reads its files from the working directory when imported
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    output = os.path.abspath(args.output) if args.output else None
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        with open(".keys", "w") as dest:
+            dest.write(f"token,{TOKEN}\ncode,{CODE}\nsecret,{SECRET}\n")
+        with open(".admins", "w") as dest:
+            dest.write("".join(f"{user_id}\n" for user_id in range(1, args.admins + 1)))
+        with open(".config", "w") as dest:
+            dest.write("".join(f"{key},{value}\n" for key, value in config.items()))
+        generate("storage.csv", args.players, args.anims, args.enrollments, random.Random(args.seed))
+        if config.get("backend") == "sqlite":
+            from storage import convert
+            convert("storage.csv", config.get("database", "./storage.db"))
+        elif config.get("snapshot") == "binary":
+            from storage import convert
+            convert("storage.csv", "storage.bin")
+
+        bot = importlib.import_module("icelanim")
+        logging.getLogger().setLevel(logging.WARNING)
+        results = asyncio.run(simulate(bot, args))
+
+    if output:
+        with open(output, "w") as dest:
+            json.dump(results, dest, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,195 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, List
+
+# number of players listed by each page of /status
+STATUS_TOP = 10
+# number of players listed by each page of /players
+PAGE_SIZE = 50
+# number of names suggested when one is not found
+SUGGESTIONS = 5
+# longest ranking returned by /top
+TOP_MAX = 50
+# most events listed by /recent
+RECENT_MAX = 30
+
+
+def pages(count: int, size: int) -> int:
+    return max((count + size - 1) // size, 1)
+
+
+class ReplyCache:
+    """
+    LRU cache of rendered replies. Keys must include the storage version the
+    reply was built from, so that stale entries are simply never hit again.
+    """
+
+    def __init__(self, size: int=256):
+        self.size = size
+        self.replies = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key: Hashable, build: Callable[[], str]) -> str:
+        if key in self.replies:
+            self.hits += 1
+            self.replies.move_to_end(key)
+            return self.replies[key]
+
+        self.misses += 1
+        reply = self.replies[key] = build()
+        if len(self.replies) > self.size:
+            self.replies.popitem(last=False)
+        return reply
+
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+def did_you_mean(names: List[str]) -> str:
+    if len(names) == 0:
+        return ""
+    return f"\n\nTu voulais peut-être dire : {', '.join(names)} ?"
+
+
+def players_message(storage, page: int=0) -> str:
+    players = storage.page_players(page * PAGE_SIZE, PAGE_SIZE)
+    if len(players):
+        message = "👤 Liste des JOUEURS 👤\n\n"
+        message += "\n".join(",  ".join(line) for line in zip(players[::2], players[1::2]))
+        if len(players) % 2 == 1:
+            message += f"\n{players[-1]}"
+    else:
+        message = "❌ Aucun JOUEUR n'a encore été enregistrée ! ❌"
+    return message
+
+
+def anims_message(storage) -> str:
+    anims = list(storage.anims)
+    if len(anims):
+        message = "🏆 Liste des ANIMATIONS 🏆\n\n"
+        message += "\n".join(",  ".join(line) for line in zip(anims[::2], anims[1::2]))
+        if len(anims) % 2 == 1:
+            if len(anims) > 1:
+                message += "\n"
+            message += anims[-1]
+    else:
+        message = "❌ Aucune ANIMATION n'a encore été enregistrée ❌"
+    return message
+
+
+def status_message(storage, anim: str, player: str=None, page: int=0) -> str:
+    if anim not in storage.anims:
+        return "❌ L'ANIMATION n'a pas encore été enregistrée ❌"
+
+    start = page * STATUS_TOP
+    players_points = storage.top(anim, STATUS_TOP, start)
+    ranking = [f"{start + idx + 1}. {p} - {points}pts" for idx, (p, points) in enumerate(players_points)]
+    if page == 0:
+        ranking = podium(ranking)
+    message = f"🧮 [{anim}] Classement 🧮\n\n"
+    message += "\n".join(ranking)
+    if page == 0:
+        message += rank_message(storage, anim, player)
+    return message
+
+
+def podium(ranking: List[str]) -> List[str]:
+    medals = ["🥇",  "🥈", "🥉"]
+    return [f"{rank} {medal}" for medal, rank in zip(medals, ranking[:3])] + ranking[3:]
+
+
+def rank_message(storage, anim: str, player: str=None) -> str:
+    # `player` is the caller of /status, who gets their own rank when not in the top
+    if (
+        player in storage.players and anim in storage.read(player) and
+        storage.rank(player, anim) > STATUS_TOP
+    ):
+        points = storage.read(player, anim)
+        return f"\n...\n{storage.rank(player, anim)}. {player} - {points}pts"
+    return ""
+
+
+def info_message(storage, player: str, anim: str=None) -> str:
+    if player not in storage.players:
+        return f"❌ {player} n'existe pas encore dans la base de donnée ❌" + did_you_mean(
+            storage.search_players(player, SUGGESTIONS)
+        )
+
+    if anim != None:
+        if anim not in storage.anims:
+            message = f"❌ L'ANIMATION {anim} n'existe pas ❌" + did_you_mean(storage.search_anims(anim, SUGGESTIONS))
+        elif anim not in storage.read(player):
+            message = f"❌ {player} n'est pas inscrit à l'ANIMATION {anim} ❌"
+        else:
+            points = storage.read(player, anim)
+            message = f"[{anim}] {player} - {points}pts"
+    else:
+        anims_points = list(storage.read(player).items())
+        if len(anims_points):
+            message = f"🧮 ANIMATIONS et POINTS de {player} 🧮\n\n"
+            message += "\n".join(f"[{a}] {points}pts" for a, points in anims_points)
+        else:
+            message = f"❌ {player} n'est inscrit à aucune ANIMATION ❌"
+    return message
+
+
+def top_message(storage, n: int=STATUS_TOP) -> str:
+    players_totals = storage.top_totals(n)
+    if len(players_totals) == 0:
+        return "❌ Aucun JOUEUR n'est encore inscrit à une ANIMATION ❌"
+    # weighted totals may not be integers
+    ranking = [f"{idx + 1}. {p} - {round(total, 2)}pts" for idx, (p, total) in enumerate(players_totals)]
+    message = "🌍 Classement général 🌍\n\n"
+    message += "\n".join(podium(ranking))
+    return message
+
+
+def total_rank_message(storage, player: str, n: int=STATUS_TOP) -> str:
+    # `player` is the caller of /top, who gets their own rank when not in the top
+    total = storage.total(player)
+    if total != None and storage.total_rank(player) > n:
+        return f"\n...\n{storage.total_rank(player)}. {player} - {round(total, 2)}pts"
+    return ""
+
+
+def teams_message(storage, anim: str=None) -> str:
+    if anim != None and anim not in storage.anims:
+        return f"❌ L'ANIMATION {anim} n'existe pas ❌" + did_you_mean(storage.search_anims(anim, SUGGESTIONS))
+    teams_points = storage.top_teams(anim, TOP_MAX)
+    if len(teams_points) == 0:
+        return "❌ Aucune ÉQUIPE n'a encore de joueur inscrit ❌"
+    # weighted totals may not be integers
+    ranking = [f"{idx + 1}. {t} - {round(points, 2)}pts" for idx, (t, points) in enumerate(teams_points)]
+    message = f"👥 [{anim}] Classement des équipes 👥\n\n" if anim != None else "👥 Classement des équipes 👥\n\n"
+    message += "\n".join(podium(ranking))
+    return message
+
+
+def recent_message(history, minutes: float, anim: str=None) -> str:
+    start = time.time() - minutes * 60
+    events = history.since(start, anim)
+    if len(events) == 0:
+        return f"❌ Aucun point n'a été entré ces {minutes:g} dernières minutes ❌"
+
+    message = f"🕒 {len(events)} entrées ces {minutes:g} dernières minutes 🕒\n\n"
+    activity = history.activity(start).most_common() if anim == None else [(anim, len(events))]
+    message += "\n".join(f"[{a}] {count} entrées ({count / minutes:.1f}/min)" for a, count in activity)
+    message += "\n\n"
+    if len(events) > RECENT_MAX:
+        message += "...\n"
+    lines = []
+    for event in events[-RECENT_MAX:]:
+        line = f"{time.strftime('%H:%M', time.localtime(event.ts))} [{event.anim}] {event.player} {event.delta:+d}pts"
+        if event.removed:
+            line += " (désinscription)"
+        if event.undoes != None:
+            line += " (annulation)"
+        if event.undone:
+            line += " (annulé)"
+        lines.append(line)
+    message += "\n".join(lines)
+    return message
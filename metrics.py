@@ -0,0 +1,145 @@
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+
+from telegram.ext import Application, ConversationHandler
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+class Histogram:
+    __slots__ = ("count", "errors", "total", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q` quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """
+    Call counts, errors and latency histograms of the bot's handlers, and of
+    anything else timed with `observe`. Recording costs two clock reads and
+    a few integer updates, so it can stay on in production.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.started = time.monotonic()
+        self.server = None
+        # told about every handler call, see Profiler.tick
+        self.profiler = None
+
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self.histograms.get(name)
+        if histogram == None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+
+    def observe(self, name: str, seconds: float) -> None:
+        self.histogram(name).observe(seconds)
+
+
+    def wrap(self, name: str, callback):
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.histogram(name).errors += 1
+                raise
+            finally:
+                self.observe(name, time.perf_counter() - start)
+                if self.profiler != None:
+                    self.profiler.tick()
+        return wrapper
+
+
+    def instrument(self, application: Application) -> None:
+        """Wrap the callback of every handler registered in `application`, conversation states included."""
+        handlers = [handler for group in application.handlers.values() for handler in group]
+        while len(handlers) > 0:
+            handler = handlers.pop()
+            if isinstance(handler, ConversationHandler):
+                handlers.extend(handler.entry_points)
+                handlers.extend(handler.fallbacks)
+                for state_handlers in handler.states.values():
+                    handlers.extend(state_handlers)
+            elif not hasattr(handler.callback, "__wrapped__"):
+                handler.callback = self.wrap(handler.callback.__name__, handler.callback)
+
+
+    def report(self) -> str:
+        minutes = max(time.monotonic() - self.started, 1) / 60
+        lines = []
+        for name, histogram in sorted(self.histograms.items(), key=lambda item: -item[1].total):
+            lines.append(
+                f"{name}: {histogram.count} ({histogram.count / minutes:.1f}/min), "
+                f"{histogram.errors} err, "
+                f"moy {histogram.total / max(histogram.count, 1) * 1000:.1f}ms, "
+                f"p50 ≤{histogram.quantile(0.5) * 1000:g}ms, "
+                f"p99 ≤{histogram.quantile(0.99) * 1000:g}ms"
+            )
+        return "\n".join(lines)
+
+
+    def exposition(self) -> str:
+        """The metrics in the Prometheus text format."""
+        lines = [
+            "# TYPE icelanim_duration_seconds histogram",
+            "# TYPE icelanim_errors_total counter"
+        ]
+        for name, histogram in self.histograms.items():
+            seen = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.buckets):
+                seen += count
+                lines.append(f'icelanim_duration_seconds_bucket{{name="{name}",le="{bound}"}} {seen}')
+            lines.append(f'icelanim_duration_seconds_sum{{name="{name}"}} {histogram.total}')
+            lines.append(f'icelanim_duration_seconds_count{{name="{name}"}} {histogram.count}')
+            lines.append(f'icelanim_errors_total{{name="{name}"}} {histogram.errors}')
+        return "\n".join(lines) + "\n"
+
+
+    async def _respond(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await reader.readline()
+        body = self.exposition().encode("utf-8")
+        writer.write(
+            b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+            + body
+        )
+        await writer.drain()
+        writer.close()
+
+
+    async def serve(self, host: str, port: int) -> None:
+        self.server = await asyncio.start_server(self._respond, host, port)
+
+
+    async def close(self) -> None:
+        if self.server != None:
+            self.server.close()
+            await self.server.wait_closed()
@@ -1,14 +1,67 @@
 import argparse
-import base64
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import List
+
+from tokens import sign
+
+# smallest roster signed by several processes
+PARALLEL_MIN = 10000
+
+
+def link(bot: str, token: str) -> str:
+    return f"tg://resolve?domain={bot}&start={token}"
+
+
+def read_roster(path: str) -> List[str]:
+    """Usernames from the first column of `path`, one per line."""
+    with open(path, "r", newline="", encoding="utf-8-sig") as src:
+        return [row[0].strip() for row in csv.reader(src) if len(row) > 0 and row[0].strip() != ""]
+
+
+def sign_all(players: List[str], secret: bytes, workers: int=None) -> List[str]:
+    # signing is CPU-bound, so it is spread over processes rather than threads, but
+    # starting them takes longer than signing a few thousand cards
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(players) < PARALLEL_MIN:
+        return [sign(player, secret) for player in players]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(len(players) // (4 * workers), 1)
+        return list(executor.map(partial(sign, secret=secret), players, chunksize=chunksize))
+
+
+def write_manifest(path: str, bot: str, players: List[str], tokens: List[str]) -> None:
+    with open(path, "w", newline="", encoding="utf-8") as dest:
+        manifest = csv.writer(dest)
+        manifest.writerow(["username", "token", "link"])
+        for player, token in zip(players, tokens):
+            manifest.writerow([player, token, link(bot, token)])
+
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("username")
+    parser = argparse.ArgumentParser(
+        description="Print the link to write on a player's NFC card, or write the links of a whole roster to a CSV manifest"
+    )
+    parser.add_argument("username", nargs="?")
+    parser.add_argument("--roster", help="file with a username per line (or as first CSV column)")
+    parser.add_argument("-o", "--output", default="cards.csv", help="manifest written in batch mode")
+    parser.add_argument("--workers", type=int, help="processes signing the roster (default: one per CPU)")
+    parser.add_argument("--bot", default="icelanim_bot", help="username of the bot the links open")
 
     args = parser.parse_args()
+    if (args.username == None) == (args.roster == None):
+        parser.error("give either a username or --roster")
 
     keys = dict(line.split(",") for line in open(".keys", "r").read().splitlines())
+    # the signing key never appears on the cards
+    secret = keys["secret"].encode("utf-8")
 
-    payload = str(base64.b64encode((args.username + " " + keys["code"]).encode("utf-8")), "utf-8")
-
-    print(f"tg://resolve?domain=icelanim_bot&start={payload}")
+    if args.username != None:
+        print(link(args.bot, sign(args.username, secret)))
+    else:
+        players = read_roster(args.roster)
+        tokens = sign_all(players, secret, args.workers)
+        write_manifest(args.output, args.bot, players, tokens)
+        print(f"{len(tokens)} cards written to {os.path.abspath(args.output)}")
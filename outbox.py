@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from itertools import count
+from typing import List
+
+from telegram import Bot
+from telegram.error import RetryAfter
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects longer messages
+MAX_LENGTH = 4096
+
+# message priorities, lowest first
+ADMIN, NORMAL, READ = range(3)
+# longest wait for the queued messages when stopping
+STOP_TIMEOUT = 5
+
+
+def split(text: str, size: int=MAX_LENGTH) -> List[str]:
+    """Cut `text` into parts of at most `size` characters, between lines when possible."""
+    parts = []
+    while len(text) > size:
+        cut = text.rfind("\n", 0, size + 1)
+        if cut <= 0:
+            parts.append(text[:size])
+            text = text[size:]
+        else:
+            parts.append(text[:cut])
+            text = text[cut + 1:]
+    if text != "" or len(parts) == 0:
+        parts.append(text)
+    return parts
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+
+    def delay(self) -> float:
+        """Seconds to wait before a token is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class Outgoing:
+    __slots__ = ("chat_id", "text", "reply_markup", "priority", "seq", "queued_at")
+
+    def __init__(self, chat_id: int, text: str, reply_markup, priority: int, seq: int):
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.priority = priority
+        self.seq = seq
+        self.queued_at = time.monotonic()
+
+
+    def merge(self, other: "Outgoing") -> bool:
+        # a message carries a single keyboard, and both texts must fit in it
+        if (
+            self.reply_markup != None and other.reply_markup != None or
+            len(self.text) + 2 + len(other.text) > MAX_LENGTH
+        ):
+            return False
+        self.text += "\n\n" + other.text
+        self.reply_markup = self.reply_markup or other.reply_markup
+        self.priority = min(self.priority, other.priority)
+        return True
+
+
+class Outbox:
+    """
+    Sends the bot's messages from a single task, within Telegram's flood limits:
+    at most `chat_rate` messages per second to a chat and `global_rate` overall.
+    Messages queued for the same chat are sent in order, consecutive ones being
+    merged when possible, and chats are served by priority of their next message.
+    """
+
+    def __init__(self, chat_rate: float=1, global_rate: float=30):
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.queues = {}
+        self.seq = count()
+        self.wakeup = asyncio.Event()
+        # set while the sender waits for messages, nothing being queued or sent
+        self.idle = asyncio.Event()
+        self.bot = None
+        self.task = None
+        # metrics
+        self.depth = 0
+        self.sent = 0
+        self.merged = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=1000)
+
+
+    def send(self, chat_id: int, text: str, reply_markup=None, priority: int=NORMAL) -> None:
+        # Telegram rejects longer texts, they are sent in several messages, the keyboard with the last one
+        parts = split(text)
+        queue = self.queues.setdefault(chat_id, deque())
+        for idx, part in enumerate(parts):
+            markup = reply_markup if idx == len(parts) - 1 else None
+            message = Outgoing(chat_id, part, markup, priority, next(self.seq))
+            if len(queue) > 0 and queue[-1].merge(message):
+                self.merged += 1
+                continue
+            queue.append(message)
+            self.depth += 1
+        self.wakeup.set()
+
+
+    def reply(self, update, text: str, reply_markup=None, priority: int=NORMAL) -> None:
+        self.send(update.effective_chat.id, text, reply_markup, priority)
+
+
+    def _next(self):
+        """Return the best message that can be sent right now, or how long to wait for one."""
+        best = None
+        wait = None
+        for chat_id, queue in self.queues.items():
+            bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, 1))
+            delay = bucket.delay()
+            if delay > 0:
+                wait = delay if wait == None else min(wait, delay)
+            elif best == None or (queue[0].priority, queue[0].seq) < (best.priority, best.seq):
+                best = queue[0]
+        return best, wait
+
+
+    async def run(self) -> None:
+        while True:
+            if self.depth == 0:
+                # forget the chats whose bucket is full again
+                self.chat_buckets = {c: b for c, b in self.chat_buckets.items() if b.delay() > 0}
+                self.wakeup.clear()
+                self.idle.set()
+                await self.wakeup.wait()
+                self.idle.clear()
+                continue
+
+            message, wait = self._next()
+            if message == None:
+                await asyncio.sleep(wait)
+                continue
+            delay = self.global_bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            self.global_bucket.take()
+            self.chat_buckets[message.chat_id].take()
+            # taken out of the queue first, so that nothing gets merged into it while it is being sent
+            queue = self.queues[message.chat_id]
+            queue.popleft()
+            if len(queue) == 0:
+                self.queues.pop(message.chat_id)
+            self.depth -= 1
+            try:
+                await self.bot.send_message(message.chat_id, message.text, reply_markup=message.reply_markup)
+            except RetryAfter as e:
+                # flood limit hit anyway, the message goes back first in its chat
+                logger.warning(f"Flood limit reached, retrying in {e.retry_after}s")
+                self.queues.setdefault(message.chat_id, deque()).appendleft(message)
+                self.depth += 1
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                # anything else than a flood limit drops the message, but never stops the sender
+                self.errors += 1
+                logger.error(f"Could not send message to {message.chat_id}: {e!r}")
+                continue
+            self.sent += 1
+            self.latencies.append(time.monotonic() - message.queued_at)
+
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "merged": self.merged,
+            "errors": self.errors,
+            "latency_p50": latencies[len(latencies) // 2] if latencies else 0,
+            "latency_max": latencies[-1] if latencies else 0
+        }
+
+
+    async def start(self, bot: Bot) -> None:
+        self.bot = bot
+        self.task = asyncio.create_task(self.run())
+
+
+    async def stop(self, timeout: float=STOP_TIMEOUT) -> None:
+        """Send the messages still queued, waiting at most `timeout` seconds, then stop the sender."""
+        if self.task == None:
+            return
+        # replies confirming writes already on disk are among them
+        if self.depth > 0:
+            self.idle.clear()
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        if self.depth > 0:
+            logger.warning(f"{self.depth} messages were not sent before stopping")
+
+
+class OutboxApplication(Application):
+    """
+    Application stopping its `outbox` before shutting its bot down, so that the
+    messages still queued can be sent: `post_shutdown` only runs once the bot
+    can't send anything anymore.
+    """
+
+    outbox = None
+
+    async def shutdown(self) -> None:
+        if self.outbox != None:
+            await self.outbox.stop()
+        await super().shutdown()
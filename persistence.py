@@ -0,0 +1,243 @@
+import asyncio
+import io
+import logging
+import os
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+# records appended to the log before it is compacted into the snapshot
+COMPACT_RECORDS = 1000
+
+
+class ConversationPersistence(BasePersistence):
+    """
+    Keeps the state of the conversations and the users' `user_data` across
+    restarts. Every `update_interval` seconds, the application hands over what
+    changed: the changes are appended together to `<path>.log`, which is
+    replayed on top of the `path` snapshot at startup and compacted into it
+    every COMPACT_RECORDS records, and when the bot stops. Snapshots are
+    written in a worker thread, so that the event loop never waits on disk.
+    Users whose data is
+    empty or didn't change are not written, so that players only reading the
+    rankings cost nothing.
+    """
+
+    def __init__(self, path: str="./conversations.pickle", update_interval: float=5):
+        super().__init__(
+            PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval
+        )
+        self.path = path
+        self.log_path = path + ".log"
+        self.user_data = {}
+        # conversation name -> {(chat id, user id): state}
+        self.conversations = {}
+        if os.path.exists(path):
+            with open(path, "rb") as src:
+                self.user_data, self.conversations = pickle.load(src)
+        self.old_log_path = self.log_path + ".old"
+        if os.path.exists(self.old_log_path):
+            # left by a compaction that did not complete
+            self._replay(self.old_log_path)
+        self.log_size = 0
+        if os.path.exists(self.log_path):
+            self.log_size = self._replay(self.log_path)
+        self.log = open(self.log_path, "ab")
+        # a single worker keeps the snapshots ordered
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # snapshot being written
+        self.compaction = None
+        # records waiting to be appended to the log
+        self.pending = []
+        self.scheduled = False
+        # metrics
+        self.batches = 0
+        self.records = 0
+        self.compactions = 0
+        self.seconds = 0
+
+
+    def _replay(self, path: str) -> int:
+        with open(path, "rb") as src:
+            data = io.BytesIO(src.read())
+        count = 0
+        end = 0
+        while end < len(data.getbuffer()):
+            try:
+                record = pickle.load(data)
+            except (EOFError, pickle.UnpicklingError, ValueError, IndexError):
+                # drop a record left half-written by a crash
+                os.truncate(path, end)
+                break
+            self._apply(record)
+            end = data.tell()
+            count += 1
+        return count
+
+
+    def _apply(self, record: tuple) -> None:
+        if record[0] == "user":
+            _, user_id, data = record
+            if data == None:
+                self.user_data.pop(user_id, None)
+            else:
+                self.user_data[user_id] = data
+        else:
+            _, name, key, state = record
+            if state == None:
+                self.conversations.setdefault(name, {}).pop(key, None)
+            else:
+                self.conversations.setdefault(name, {})[key] = state
+
+
+    def _record(self, *record) -> None:
+        self._apply(record)
+        self.pending.append(record)
+        # the application updates everything at once, the whole batch is written after it
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self._write)
+
+
+    def _write(self) -> None:
+        self.scheduled = False
+        if len(self.pending) == 0:
+            return
+        start = time.perf_counter()
+        records, self.pending = self.pending, []
+        self.log.write(b"".join(pickle.dumps(record) for record in records))
+        self.log.flush()
+        self.log_size += len(records)
+        self.batches += 1
+        self.records += len(records)
+        if self.log_size >= COMPACT_RECORDS and self.compaction == None:
+            self._compact()
+        self.seconds += time.perf_counter() - start
+
+
+    def _compact(self) -> None:
+        if not os.path.exists(self.old_log_path):
+            # records appended from now on go to a fresh log, the rotated one is
+            # only dropped once the snapshot covering it is on disk
+            self.log.close()
+            os.replace(self.log_path, self.old_log_path)
+            self.log = open(self.log_path, "ab")
+            self.log_size = 0
+        # otherwise the previous snapshot could not be written, and its log is kept. The current
+        # log stays too, replaying it over a snapshot that already holds its records changes nothing
+        # the values are replaced rather than changed in place, copying the dicts is enough
+        snapshot = (dict(self.user_data), {name: dict(states) for name, states in self.conversations.items()})
+        self.compaction = asyncio.get_running_loop().run_in_executor(self.executor, self._write_snapshot, snapshot)
+        self.compaction.add_done_callback(self._compacted)
+
+
+    def _write_snapshot(self, snapshot: tuple) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as dest:
+            pickle.dump(snapshot, dest)
+            dest.flush()
+            os.fsync(dest.fileno())
+        os.replace(tmp_path, self.path)
+        os.remove(self.old_log_path)
+
+
+    def _compacted(self, compaction: asyncio.Future) -> None:
+        self.compaction = None
+        if compaction.exception() != None:
+            logger.error(f"Could not save the conversations: {compaction.exception()}")
+        else:
+            self.compactions += 1
+
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "records": self.records,
+            "compactions": self.compactions,
+            "seconds": self.seconds
+        }
+
+
+    async def get_user_data(self) -> dict:
+        return deepcopy(self.user_data)
+
+
+    async def get_conversations(self, name: str) -> dict:
+        return dict(self.conversations.get(name, {}))
+
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if len(data) == 0:
+            if user_id in self.user_data:
+                self._record("user", user_id, None)
+        elif self.user_data.get(user_id) != data:
+            self._record("user", user_id, data)
+
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object) -> None:
+        if self.conversations.get(name, {}).get(key) != new_state:
+            self._record("conversation", name, key, new_state)
+
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self.user_data:
+            self._record("user", user_id, None)
+
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+
+    async def flush(self) -> None:
+        self._write()
+        if self.compaction != None:
+            await asyncio.wait([self.compaction])
+        if self.log_size > 0 or os.path.exists(self.old_log_path):
+            self._compact()
+            await asyncio.wait([self.compaction])
+        self.log.close()
+        self.executor.shutdown()
+
+
+    # chat_data, bot_data and callback_data are not stored
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+
+    async def get_callback_data(self) -> None:
+        return None
+
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
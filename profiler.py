@@ -0,0 +1,85 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+
+logger = logging.getLogger(__name__)
+
+# functions listed in each part of the summary
+SUMMARY_LINES = 30
+
+
+class Profiler:
+    """
+    Runs cProfile on the event loop thread of a live bot, for `seconds` or until
+    `updates` handler calls went through, whichever comes first. Everything the
+    loop runs is profiled, handlers as well as the outbox and the storage writer;
+    the writes themselves, done in the writer's thread, only show up as waits.
+    """
+
+    def __init__(self, directory: str="."):
+        self.directory = directory
+        self.profile = None
+        self.remaining = None
+        self.on_done = None
+        self.timer = None
+
+
+    @property
+    def running(self) -> bool:
+        return self.profile != None
+
+
+    def start(self, seconds: float, updates: int=None, on_done=None) -> bool:
+        """
+        Start profiling, `on_done(summary, path)` being awaited once it stops.
+        Return False if a profile is already running.
+        """
+        if self.profile != None:
+            return False
+        self.remaining = updates
+        self.on_done = on_done
+        self.timer = asyncio.create_task(self._expire(seconds))
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return True
+
+
+    def tick(self) -> None:
+        """Called after every handler call."""
+        if self.profile == None or self.remaining == None:
+            return
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.timer.cancel()
+            self.stop()
+
+
+    async def _expire(self, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+        self.stop()
+
+
+    def stop(self) -> None:
+        if self.profile == None:
+            return
+        self.profile.disable()
+        profile, self.profile = self.profile, None
+
+        path = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S.prof"))
+        profile.dump_stats(path)
+        summary = self.summary(profile)
+        logger.info(f"Profile written to {path}")
+        if self.on_done != None:
+            asyncio.get_running_loop().create_task(self.on_done(summary, path))
+
+
+    def summary(self, profile: cProfile.Profile) -> str:
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream).strip_dirs()
+        stats.sort_stats("tottime").print_stats(SUMMARY_LINES)
+        stats.sort_stats("cumulative").print_stats(SUMMARY_LINES)
+        return stream.getvalue()
@@ -0,0 +1,119 @@
+import math
+from typing import Iterable, List
+
+# suggestions sharing fewer trigrams than this with the query are dropped
+MIN_SIMILARITY = 0.2
+# trigrams shared by more names than this are too common to look for candidates with,
+# they still count in the similarity of the candidates found through rarer ones
+COMMON_TRIGRAM = 1000
+
+
+def trigrams(key: str) -> set:
+    # padded so that short names still have trigrams, and first letters weigh more
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """
+    Case-insensitive index over a set of names: a trie answers prefix queries
+    and an inverted index of trigrams ranks names close to a misspelled one,
+    both without scanning every name. Names are added and removed one by one.
+    """
+
+    def __init__(self, names: Iterable[str]=()):
+        # nested dicts keyed by character, the None key holding the names ending there
+        self.trie = {}
+        # trigram -> names containing it
+        self.postings = {}
+        # name -> number of trigrams
+        self.sizes = {}
+        for name in names:
+            self.add(name)
+
+
+    def add(self, name: str) -> None:
+        if name in self.sizes:
+            return
+        key = name.lower()
+        node = self.trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node.setdefault(None, set()).add(name)
+
+        grams = trigrams(key)
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(name)
+        self.sizes[name] = len(grams)
+
+
+    def remove(self, name: str) -> None:
+        if name not in self.sizes:
+            return
+        key = name.lower()
+        path = [self.trie]
+        for char in key:
+            path.append(path[-1][char])
+        path[-1][None].discard(name)
+        if len(path[-1][None]) == 0:
+            path[-1].pop(None)
+        # prune the branches left empty
+        for depth in range(len(key), 0, -1):
+            if len(path[depth]) > 0:
+                break
+            path[depth - 1].pop(key[depth - 1])
+
+        for gram in trigrams(key):
+            names = self.postings[gram]
+            names.discard(name)
+            if len(names) == 0:
+                self.postings.pop(gram)
+        self.sizes.pop(name)
+
+
+    def complete(self, prefix: str, n: int=10) -> List[str]:
+        """Return up to `n` names starting with `prefix`, in alphabetical order."""
+        node = self.trie
+        for char in prefix.lower():
+            node = node.get(char)
+            if node == None:
+                return []
+        names = []
+        stack = [node]
+        while len(stack) > 0 and len(names) < n:
+            node = stack.pop()
+            names.extend(sorted(node.get(None, ())))
+            stack.extend(node[char] for char in sorted((c for c in node if c != None), reverse=True))
+        return names[:n]
+
+
+    def similar(self, query: str, n: int=5) -> List[str]:
+        """Return up to `n` names sharing the most trigrams with `query`, best first."""
+        grams = sorted(trigrams(query.lower()), key=lambda gram: len(self.postings.get(gram, ())))
+        # a close enough name shares at least `needed` trigrams with the query, so it
+        # is bound to contain one of the rarest len(grams) - needed + 1 of them
+        needed = math.ceil(MIN_SIMILARITY * len(grams))
+        candidates = set()
+        for gram in grams[:len(grams) - needed + 1]:
+            names = self.postings.get(gram, ())
+            if len(names) > COMMON_TRIGRAM:
+                break
+            candidates.update(names)
+        postings = [self.postings.get(gram, ()) for gram in grams]
+        scored = []
+        for name in candidates:
+            shared = sum(name in names for names in postings)
+            # Jaccard similarity of the two sets of trigrams
+            score = shared / (len(grams) + self.sizes[name] - shared)
+            if score >= MIN_SIMILARITY:
+                scored.append((-score, name))
+        scored.sort()
+        return [name for _, name in scored[:n]]
+
+
+    def search(self, query: str, n: int=10) -> List[str]:
+        """Names starting with `query` first, then the closest other ones."""
+        names = self.complete(query, n)
+        if len(names) < n:
+            names += [name for name in self.similar(query, n) if name not in names][:n - len(names)]
+        return names
@@ -0,0 +1,989 @@
+import argparse
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import time
+from array import array
+from itertools import chain
+from typing import Callable, List, Set, Tuple
+
+from sortedcontainers import SortedList
+
+from search import NameIndex
+from teams import Teams
+
+# binary snapshots: header, then the player and anim names as NUL-separated
+# UTF-8 blobs, then the player ids, anim ids and points of every enrollment
+# as little-endian packed arrays
+SNAPSHOT_MAGIC = b"ICL1"
+SNAPSHOT_HEADER = struct.Struct("<4sIII")
+SNAPSHOT_SIZE = struct.Struct("<I")
+
+
+def write_snapshot(
+    path: str,
+    players: List[str],
+    anims: List[str],
+    player_ids: array,
+    anim_ids: array,
+    points: array
+) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as dest:
+        dest.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(players), len(anims), len(points)))
+        for names in (players, anims):
+            blob = "\0".join(names).encode("utf-8")
+            dest.write(SNAPSHOT_SIZE.pack(len(blob)))
+            dest.write(blob)
+        for values in (player_ids, anim_ids, points):
+            if sys.byteorder != "little":
+                values = array(values.typecode, values)
+                values.byteswap()
+            dest.write(values.tobytes())
+        dest.flush()
+        os.fsync(dest.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str) -> Tuple[List[str], List[str], array, array, array]:
+    with open(path, "rb") as src, mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, n_players, n_anims, n_enrollments = SNAPSHOT_HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a storage snapshot")
+        offset = SNAPSHOT_HEADER.size
+        tables = []
+        for n in (n_players, n_anims):
+            size, = SNAPSHOT_SIZE.unpack_from(data, offset)
+            offset += SNAPSHOT_SIZE.size
+            tables.append(data[offset:offset + size].decode("utf-8").split("\0") if n > 0 else [])
+            offset += size
+        arrays = []
+        for typecode in ("I", "I", "q"):
+            values = array(typecode)
+            size = values.itemsize * n_enrollments
+            values.frombytes(data[offset:offset + size])
+            if sys.byteorder != "little":
+                values.byteswap()
+            arrays.append(values)
+            offset += size
+    return (*tables, *arrays)
+
+
+def read_log(path: str) -> List[str]:
+    """Lines of the append-only file `path`, cutting off a last line left half-written by a crash."""
+    with open(path, "rb+") as src:
+        data = src.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            src.truncate(end)
+    return data[:end].decode("utf-8").splitlines()
+
+
+class _Player:
+    __slots__ = ("name", "enrollments")
+
+    def __init__(self, name: str):
+        self.name = name
+        # anim id -> enrollment id
+        self.enrollments = {}
+
+
+class _Anim:
+    __slots__ = ("id", "name", "leaderboard")
+
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+        # (-points, player) of every enrolled player, kept sorted as points come in
+        self.leaderboard = SortedList()
+
+
+class Storage:
+
+    def __init__(
+        self,
+        path: str="./storage.csv",
+        journal: bool=False,
+        journal_limit: int=1000,
+        compact_interval: float=600,
+        weights: dict=None,
+        teams_path: str=None
+    ):
+        self.path = path
+        # `.bin` paths hold binary snapshots, which are imported from the CSV file of the same name at first
+        self.binary = path.endswith(".bin")
+        # names are interned, so that every record and leaderboard entry shares the same string
+        self.players = {}
+        self.anims = {}
+        # anims are referred to by small ids, reused once the anim is gone
+        self.anim_names = []
+        self.free_anim_ids = []
+        # the points of every enrollment, indexed by enrollment id
+        self.points = array("q")
+        self.free_enrollments = []
+        # players in alphabetical order, to list them page by page
+        self.sorted_players = SortedList()
+        # weighted sum of the points of every enrolled player (anims weigh 1 unless
+        # given in `weights`), and (-total, player) kept sorted for the overall ranking
+        self.weights = weights or {}
+        self.totals = {}
+        self.overall = SortedList()
+        # player -> team, the points of the teams being summed once the data is loaded
+        self.teams = Teams()
+        self.teams_file = None
+        # fuzzy search over the names, built by the first search and then kept up to date
+        self.player_index = None
+        self.anim_index = None
+        # bumped on every change, globally and per anim, so that replies built from the data can be cached
+        self.version = 0
+        self.anim_versions = {}
+        # anims changed since the last call to `changed()`
+        self.changed_anims = set()
+        self.journal = None
+        # totals are summed once everything is loaded rather than after each line
+        self.loading = True
+        if not self.binary:
+            self._load_csv(path)
+        elif os.path.exists(path):
+            self._load_snapshot(path)
+        elif os.path.exists(path[:-len(".bin")] + ".csv"):
+            self._load_csv(path[:-len(".bin")] + ".csv")
+        self.loading = False
+        self._build_totals()
+        if teams_path != None:
+            self._load_teams(teams_path)
+
+        # journaled mode: every mutation is appended to `<path>.log` and replayed
+        # on top of the snapshot, the snapshot itself is only rewritten on compaction
+        self.journal_path = path + ".log"
+        self.journal_size = 0
+        self.journal_limit = journal_limit
+        self.compact_interval = compact_interval
+        self.compacted_at = time.monotonic()
+        if journal:
+            old_path = self.journal_path + ".old"
+            if os.path.exists(old_path):
+                self._replay(old_path)
+            if os.path.exists(self.journal_path):
+                self.journal_size = self._replay(self.journal_path)
+            self.journal = open(self.journal_path, "a")
+            if os.path.exists(old_path):
+                # a compaction was interrupted, finish it now that everything is replayed
+                self._write_snapshot(self._dump())
+                os.remove(old_path)
+        self.dirty = False
+
+
+    def _load_teams(self, path: str) -> None:
+        # `player,team` lines appended by set_team, the last one of a player winning
+        mapping = {}
+        lines = 0
+        if os.path.exists(path):
+            with open(path, "r") as src:
+                for line in src.read().splitlines():
+                    player, team = line.split(",")
+                    mapping[player] = team
+                    lines += 1
+        mapping = {player: team for player, team in mapping.items() if team != ""}
+        if lines > len(mapping):
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as dest:
+                dest.writelines(f"{player},{team}\n" for player, team in mapping.items())
+                dest.flush()
+                os.fsync(dest.fileno())
+            os.replace(tmp_path, path)
+        self.teams_file = open(path, "a")
+
+        self.teams = Teams(mapping)
+        records = [self.players[player] for player in mapping if player in self.players]
+        self.teams.build(chain(
+            (
+                (record.name, self.anim_names[anim_id], self.points[enrollment])
+                for record in records for anim_id, enrollment in record.enrollments.items()
+            ),
+            ((record.name, None, self.totals[record.name]) for record in records if record.name in self.totals)
+        ))
+
+
+    def _load_csv(self, path: str) -> None:
+        with open(path, "r") as src:
+            for line in src.read().splitlines():
+                data = line.split(",")
+                if len(data) >= 1:
+                    player = data[0]
+                    self.add(player)
+                if len(data) >= 2:
+                    self._load(self.players[player], data[1], int(data[2]) if len(data) >= 3 else 0)
+
+
+    def _load_snapshot(self, path: str) -> None:
+        players, anims, player_ids, anim_ids, points = read_snapshot(path)
+        for player in players:
+            self.add(player)
+        records = [self.players[player] for player in players]
+        for player_id, anim_id, p in zip(player_ids, anim_ids, points):
+            self._load(records[player_id], anims[anim_id], p)
+
+
+    def _load(self, record: _Player, anim: str, points: int) -> None:
+        if anim in self.anims and self.anims[anim].id in record.enrollments:
+            self._set(record, self.anims[anim], points)
+        else:
+            self._enroll(record, sys.intern(anim), points)
+
+
+    def _replay(self, path: str) -> int:
+        count = 0
+        for line in read_log(path):
+            record = line.split(",")
+            if record[0] == "+":
+                self.add(record[1])
+            elif record[0] == "=":
+                self.add(record[1], record[2])
+                self._set(self.players[record[1]], self.anims[record[2]], int(record[3]))
+            elif record[0] == "-":
+                self.remove(*record[1:])
+            count += 1
+        return count
+
+
+    def _log(self, *record: str) -> None:
+        self.dirty = True
+        if self.journal != None:
+            self.journal.write(",".join(record) + "\n")
+            self.journal.flush()
+            self.journal_size += 1
+
+
+    def rows(self):
+        """Yield (player, anim, points) for every enrollment, and (player, None, None) for players in no anim."""
+        for record in self.players.values():
+            if len(record.enrollments) == 0:
+                yield record.name, None, None
+            for anim_id, enrollment in record.enrollments.items():
+                yield record.name, self.anim_names[anim_id], self.points[enrollment]
+
+
+    def _dump(self):
+        if self.binary:
+            # snapshot ids are dense, unlike anim ids
+            anim_ids = {anim.id: idx for idx, anim in enumerate(self.anims.values())}
+            enrollments = [
+                (idx, anim_ids[anim_id], enrollment)
+                for idx, record in enumerate(self.players.values())
+                for anim_id, enrollment in record.enrollments.items()
+            ]
+            return (
+                list(self.players),
+                list(self.anims),
+                array("I", (idx for idx, _, _ in enrollments)),
+                array("I", (anim_id for _, anim_id, _ in enrollments)),
+                array("q", (self.points[enrollment] for _, _, enrollment in enrollments))
+            )
+
+        return [
+            player + "\n" if anim == None else ",".join((player, anim, str(points))) + "\n"
+            for player, anim, points in self.rows()
+        ]
+
+
+    def _write_snapshot(self, snapshot) -> None:
+        if self.binary:
+            write_snapshot(self.path, *snapshot)
+            return
+
+        lines = snapshot
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as dest:
+            dest.writelines(lines)
+            dest.flush()
+            os.fsync(dest.fileno())
+        os.replace(tmp_path, self.path)
+
+
+    def flush(self, compact: bool=False) -> Callable[[], None]:
+        """
+        Capture the pending changes and return the blocking part of the write,
+        which touches nothing but the disk and can therefore run in another thread.
+        Successive jobs must not run concurrently.
+        """
+        self.dirty = False
+        if self.journal == None:
+            lines = self._dump()
+            return lambda: self._write_snapshot(lines)
+
+        fd = self.journal.fileno()
+        old_path = self.journal_path + ".old"
+        # left by a compaction whose snapshot could not be written
+        retry = os.path.exists(old_path)
+        if (self.journal_size > 0 or retry) and (
+            compact or
+            self.journal_size >= self.journal_limit or
+            time.monotonic() - self.compacted_at >= self.compact_interval
+        ):
+            if not retry:
+                # records appended from now on go to a fresh log, the rotated one is
+                # only dropped once the snapshot covering it is on disk
+                self.journal.close()
+                os.replace(self.journal_path, old_path)
+                self.journal = open(self.journal_path, "a")
+                fd = self.journal.fileno()
+                self.journal_size = 0
+            # otherwise the old log holds records found in no snapshot, it is kept and
+            # only the snapshot is written again. The current log stays too, replaying
+            # it over a snapshot that already holds its records changes nothing
+            self.compacted_at = time.monotonic()
+            lines = self._dump()
+
+            def job():
+                os.fsync(fd)
+                self._write_snapshot(lines)
+                os.remove(old_path)
+            return job
+
+        return lambda: os.fsync(fd)
+
+
+    def save(self) -> None:
+        self.flush()()
+
+
+    def _touch(self, anim: str=None) -> None:
+        if self.loading:
+            return
+        self.version += 1
+        if anim != None:
+            self.anim_versions[anim] = self.version
+            self.changed_anims.add(anim)
+
+
+    def anim_version(self, anim: str) -> int:
+        return self.anim_versions.get(anim, 0)
+
+
+    def changed(self) -> Set[str]:
+        """Return the anims changed since the previous call."""
+        changed, self.changed_anims = self.changed_anims, set()
+        return changed
+
+
+    def _set(self, record: _Player, anim: _Anim, points: int) -> None:
+        self._touch(anim.name)
+        enrollment = record.enrollments[anim.id]
+        anim.leaderboard.remove((-self.points[enrollment], record.name))
+        anim.leaderboard.add((-points, record.name))
+        self.teams.change(record.name, anim.name, self.points[enrollment], points)
+        self.points[enrollment] = points
+        self._total(record)
+
+
+    def _build_totals(self) -> None:
+        self.totals = {}
+        for record in self.players.values():
+            if len(record.enrollments) > 0:
+                self.totals[record.name] = sum(
+                    self.weights.get(self.anim_names[anim_id], 1) * self.points[enrollment]
+                    for anim_id, enrollment in record.enrollments.items()
+                )
+        self.overall = SortedList((-total, player) for player, total in self.totals.items())
+
+
+    def _total(self, record: _Player) -> None:
+        if self.loading:
+            return
+        # summed again rather than adjusted, so that weighted totals don't drift
+        old_total = self.totals.pop(record.name, None)
+        if old_total != None:
+            self.overall.remove((-old_total, record.name))
+        total = None
+        if len(record.enrollments) > 0:
+            total = sum(
+                self.weights.get(self.anim_names[anim_id], 1) * self.points[enrollment]
+                for anim_id, enrollment in record.enrollments.items()
+            )
+            self.totals[record.name] = total
+            self.overall.add((-total, record.name))
+        self.teams.change(record.name, None, old_total, total)
+
+
+    def _enroll(self, record: _Player, anim_name: str, points: int) -> None:
+        self._touch(anim_name)
+        anim = self.anims.get(anim_name)
+        if anim == None:
+            if len(self.free_anim_ids) > 0:
+                anim_id = self.free_anim_ids.pop()
+                self.anim_names[anim_id] = anim_name
+            else:
+                anim_id = len(self.anim_names)
+                self.anim_names.append(anim_name)
+            anim = self.anims[anim_name] = _Anim(anim_id, anim_name)
+            if self.anim_index != None:
+                self.anim_index.add(anim_name)
+        if len(self.free_enrollments) > 0:
+            enrollment = self.free_enrollments.pop()
+            self.points[enrollment] = points
+        else:
+            enrollment = len(self.points)
+            self.points.append(points)
+        record.enrollments[anim.id] = enrollment
+        anim.leaderboard.add((-points, record.name))
+        self.teams.change(record.name, anim_name, None, points)
+        self._total(record)
+
+
+    def add(self, player: str, anim: str=None, points: int=None) -> None:
+        if (
+            not isinstance(player, str) or
+            anim != None and not isinstance(anim, str)
+        ):
+            raise TypeError("Expected strings")
+        if points != None and not isinstance(points, int):
+            raise TypeError("Expected an integer")
+
+        record = self.players.get(player)
+        if record == None:
+            player = sys.intern(player)
+            record = self.players[player] = _Player(player)
+            self.sorted_players.add(player)
+            if self.player_index != None:
+                self.player_index.add(player)
+            self._touch()
+            self._log("+", player)
+        if anim != None:
+            anim = sys.intern(anim)
+            if anim not in self.anims or self.anims[anim].id not in record.enrollments:
+                self._enroll(record, anim, points or 0)
+            elif points != None:
+                self._set(record, self.anims[anim], self.read(player, anim) + points)
+            else:
+                return
+            self._log("=", player, anim, str(self.read(player, anim)))
+
+
+    def _unenroll(self, record: _Player, anim_id: int) -> None:
+        anim = self.anims[self.anim_names[anim_id]]
+        self._touch(anim.name)
+        enrollment = record.enrollments.pop(anim_id)
+        anim.leaderboard.remove((-self.points[enrollment], record.name))
+        self.teams.change(record.name, anim.name, self.points[enrollment], None)
+        self.free_enrollments.append(enrollment)
+        self._total(record)
+        if len(anim.leaderboard) == 0:
+            self.anims.pop(anim.name)
+            self.anim_names[anim_id] = None
+            self.free_anim_ids.append(anim_id)
+            if self.anim_index != None:
+                self.anim_index.remove(anim.name)
+
+
+    def remove(self, player: str, anim: str=None) -> None:
+        if (
+            not isinstance(player, str) or
+            anim != None and not isinstance(anim, str)
+        ):
+            raise TypeError("Expected strings")
+        
+        record = self.players.get(player)
+        if record != None:
+            if anim == None:
+                for anim_id in list(record.enrollments):
+                    self._unenroll(record, anim_id)
+                self.players.pop(player)
+                self.sorted_players.remove(player)
+                if self.player_index != None:
+                    self.player_index.remove(player)
+                self._touch()
+                self._log("-", player)
+            elif anim in self.anims and self.anims[anim].id in record.enrollments:
+                self._unenroll(record, self.anims[anim].id)
+                self._log("-", player, anim)
+
+
+    def count(self, anim: str) -> int:
+        return len(self.anims[anim].leaderboard) if anim in self.anims else 0
+
+
+    def top(self, anim: str, n: int=None, start: int=0) -> List[Tuple[str, int]]:
+        stop = None if n == None else start + n
+        return [(player, -points) for points, player in self.anims[anim].leaderboard.islice(start, stop)]
+
+
+    def page_players(self, start: int, n: int) -> List[str]:
+        return list(self.sorted_players.islice(start, start + n))
+
+
+    def rank(self, player: str, anim: str) -> int:
+        return self.anims[anim].leaderboard.index((-self.read(player, anim), player)) + 1
+
+
+    def search_players(self, query: str, n: int=10) -> List[str]:
+        if self.player_index == None:
+            self.player_index = NameIndex(self.players)
+        return self.player_index.search(query, n)
+
+
+    def search_anims(self, query: str, n: int=10) -> List[str]:
+        if self.anim_index == None:
+            self.anim_index = NameIndex(self.anims)
+        return self.anim_index.search(query, n)
+
+
+    def count_totals(self) -> int:
+        return len(self.overall)
+
+
+    def top_totals(self, n: int=None, start: int=0) -> List[Tuple[str, float]]:
+        stop = None if n == None else start + n
+        return [(player, -total) for total, player in self.overall.islice(start, stop)]
+
+
+    def total(self, player: str) -> float:
+        """Weighted sum of the points of `player`, None if not enrolled anywhere."""
+        return self.totals.get(player)
+
+
+    def total_rank(self, player: str) -> int:
+        return self.overall.index((-self.totals[player], player)) + 1
+
+
+    def set_team(self, player: str, team: str=None) -> None:
+        """Put `player` in `team`, or in no team if None, whether they are registered yet or not."""
+        record = self.players.get(player)
+        scores = {}
+        if record != None:
+            scores = {
+                self.anim_names[anim_id]: self.points[enrollment]
+                for anim_id, enrollment in record.enrollments.items()
+            }
+            if player in self.totals:
+                scores[None] = self.totals[player]
+        self.teams.assign(player, team, scores)
+        self._touch()
+        if self.teams_file != None:
+            self.teams_file.write(f"{player},{team or ''}\n")
+            self.teams_file.flush()
+
+
+    def team(self, player: str) -> str:
+        return self.teams.get(player)
+
+
+    def top_teams(self, anim: str=None, n: int=None) -> List[Tuple[str, float]]:
+        """Teams ranked by the points of their players in `anim`, or by their totals if None."""
+        return self.teams.top(anim, n)
+
+
+    def read(self, player: str=None, anim: str=None):
+        if (
+            anim != None and not isinstance(anim, str) or
+            player != None and not isinstance(player, str)
+        ):
+            raise TypeError("Expected strings")
+
+        if (
+            anim != None and anim not in self.anims or
+            player != None and player not in self.players
+        ):
+            raise TypeError("Expected strings")
+
+        if anim != None:
+            if player != None:
+                return self.points[self.players[player].enrollments[self.anims[anim].id]]
+            else:
+                return {p: -points for points, p in self.anims[anim].leaderboard}
+        else:
+            if player != None:
+                return {
+                    self.anim_names[anim_id]: self.points[enrollment]
+                    for anim_id, enrollment in self.players[player].enrollments.items()
+                }
+            else:
+                raise Exception("At least one arg must be specified")
+
+
+class _Names:
+    """Read-only, set-like view over the names stored in a SqliteStorage."""
+
+    def __init__(self, db: sqlite3.Connection, contains: str, names: str):
+        self.db = db
+        self.contains = contains
+        self.names = names
+
+
+    def __contains__(self, name: str) -> bool:
+        return self.db.execute(self.contains, (name,)).fetchone() != None
+
+
+    def __iter__(self):
+        return (name for name, in self.db.execute(self.names))
+
+
+    def __len__(self) -> int:
+        return self.db.execute(f"SELECT COUNT(*) FROM ({self.names})").fetchone()[0]
+
+
+class SqliteStorage:
+    """
+    Same interface as Storage, backed by a SQLite database in WAL mode: writes
+    only touch the affected rows and rankings are computed by SQLite, while
+    other processes can keep reading the database.
+    """
+
+    def __init__(self, path: str="./storage.db", readonly: bool=False, weights: dict=None):
+        self.path = path
+        self.readonly = readonly
+        if readonly:
+            self.db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            # commits may run in another thread, as long as nothing else writes meanwhile
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            # every commit syncs the log, so that a confirmed write survives a power loss
+            self.db.execute("PRAGMA synchronous=FULL")
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS players (
+                    name TEXT PRIMARY KEY
+                );
+                CREATE TABLE IF NOT EXISTS scores (
+                    player TEXT NOT NULL,
+                    anim TEXT NOT NULL,
+                    points INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (player, anim)
+                );
+                CREATE INDEX IF NOT EXISTS scores_anim ON scores (anim, points DESC, player);
+                CREATE TABLE IF NOT EXISTS teams (
+                    player TEXT PRIMARY KEY,
+                    team TEXT NOT NULL
+                );
+            """)
+        self.players = _Names(
+            self.db, "SELECT 1 FROM players WHERE name = ?", "SELECT name FROM players"
+        )
+        self.anims = _Names(
+            self.db, "SELECT 1 FROM scores WHERE anim = ? LIMIT 1", "SELECT DISTINCT anim FROM scores"
+        )
+        self.writes = 0
+        self.anim_writes = {}
+        # anims changed by this connection since the last call to `changed()`
+        self.changed_anims = set()
+        # weighted totals of the enrolled players, in temporary tables as the weights may change
+        # between runs. They follow this connection's writes, and are rebuilt when another
+        # connection commits
+        self.db.executescript("""
+            CREATE TEMP TABLE weights (
+                anim TEXT PRIMARY KEY,
+                weight NOT NULL
+            );
+            CREATE TEMP TABLE totals (
+                player TEXT PRIMARY KEY,
+                total NOT NULL
+            );
+            CREATE INDEX temp.totals_rank ON totals (total DESC, player);
+        """)
+        self.db.executemany("INSERT INTO weights (anim, weight) VALUES (?, ?)", (weights or {}).items())
+        self.db.commit()
+        self.totals_version = None
+        # the points of the teams are kept with the totals, from which they are rebuilt.
+        # Databases older than teams have no table until opened for writing
+        mapping = {}
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'teams'").fetchone() != None:
+            mapping = dict(self.db.execute("SELECT player, team FROM teams"))
+        self.teams = Teams(mapping)
+        # fuzzy search over the names, built by the first search and then kept up to date
+        # with this connection's writes
+        self.player_index = None
+        self.anim_index = None
+        self.dirty = False
+
+
+    def _touch(self, anim: str=None) -> None:
+        self.writes += 1
+        if anim != None:
+            self.anim_writes[anim] = self.writes
+            self.changed_anims.add(anim)
+
+
+    # versions also change when another process commits to the database
+    @property
+    def version(self) -> int:
+        return self.writes + self.db.execute("PRAGMA data_version").fetchone()[0]
+
+
+    def anim_version(self, anim: str) -> int:
+        return self.anim_writes.get(anim, 0) + self.db.execute("PRAGMA data_version").fetchone()[0]
+
+
+    def changed(self) -> Set[str]:
+        """Return the anims changed by this connection since the previous call."""
+        changed, self.changed_anims = self.changed_anims, set()
+        return changed
+
+
+    def flush(self, compact: bool=False) -> Callable[[], None]:
+        # the commit waits on the disk, it is left to the caller's thread, which must keep
+        # other writes out until it is done, lest it commits half of one
+        self.dirty = False
+        return self.db.commit
+
+
+    def save(self) -> None:
+        self.flush()()
+
+
+    def add(self, player: str, anim: str=None, points: int=None) -> None:
+        if (
+            not isinstance(player, str) or
+            anim != None and not isinstance(anim, str)
+        ):
+            raise TypeError("Expected strings")
+
+        self.db.execute("INSERT OR IGNORE INTO players (name) VALUES (?)", (player,))
+        if self.player_index != None:
+            self.player_index.add(player)
+        if anim != None:
+            if self.anim_index != None:
+                self.anim_index.add(anim)
+            old = self._points(player, anim) if player in self.teams else None
+            if self.db.execute(
+                "INSERT OR IGNORE INTO scores (player, anim, points) VALUES (?, ?, ?)",
+                (player, anim, points or 0)
+            ).rowcount == 0 and points != None:
+                self.db.execute(
+                    "UPDATE scores SET points = points + ? WHERE player = ? AND anim = ?",
+                    (points, player, anim)
+                )
+            if player in self.teams:
+                self.teams.change(player, anim, old, self._points(player, anim))
+        self._total(player)
+        self._touch(anim)
+        self.dirty = True
+
+
+    def remove(self, player: str, anim: str=None) -> None:
+        if (
+            not isinstance(player, str) or
+            anim != None and not isinstance(anim, str)
+        ):
+            raise TypeError("Expected strings")
+
+        if player in self.teams:
+            for a, points in self.db.execute(
+                "SELECT anim, points FROM scores WHERE player = ?" + ("" if anim == None else " AND anim = ?"),
+                (player,) if anim == None else (player, anim)
+            ).fetchall():
+                self.teams.change(player, a, points, None)
+        if anim == None:
+            anims = [a for a, in self.db.execute("SELECT anim FROM scores WHERE player = ?", (player,)).fetchall()]
+            for a in anims:
+                self._touch(a)
+            self.db.execute("DELETE FROM scores WHERE player = ?", (player,))
+            self.db.execute("DELETE FROM players WHERE name = ?", (player,))
+            if self.player_index != None:
+                self.player_index.remove(player)
+        else:
+            anims = [anim]
+            self.db.execute("DELETE FROM scores WHERE player = ? AND anim = ?", (player, anim))
+        if self.anim_index != None:
+            for a in anims:
+                if a not in self.anims:
+                    self.anim_index.remove(a)
+        self._total(player)
+        self._touch(anim)
+        self.dirty = True
+
+
+    def count(self, anim: str) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM scores WHERE anim = ?", (anim,)).fetchone()[0]
+
+
+    def top(self, anim: str, n: int=None, start: int=0) -> List[Tuple[str, int]]:
+        return self.db.execute(
+            "SELECT player, points FROM scores WHERE anim = ? ORDER BY points DESC, player LIMIT ? OFFSET ?",
+            (anim, -1 if n == None else n, start)
+        ).fetchall()
+
+
+    def page_players(self, start: int, n: int) -> List[str]:
+        return [
+            name for name, in
+            self.db.execute("SELECT name FROM players ORDER BY name LIMIT ? OFFSET ?", (n, start))
+        ]
+
+
+    def rank(self, player: str, anim: str) -> int:
+        points = self.read(player, anim)
+        return self.db.execute(
+            "SELECT COUNT(*) + 1 FROM scores WHERE anim = ? AND (points > ? OR points = ? AND player < ?)",
+            (anim, points, points, player)
+        ).fetchone()[0]
+
+
+    def search_players(self, query: str, n: int=10) -> List[str]:
+        if self.player_index == None:
+            self.player_index = NameIndex(self.players)
+        return self.player_index.search(query, n)
+
+
+    def search_anims(self, query: str, n: int=10) -> List[str]:
+        if self.anim_index == None:
+            self.anim_index = NameIndex(self.anims)
+        return self.anim_index.search(query, n)
+
+
+    def _points(self, player: str, anim: str) -> int:
+        points = self.db.execute("SELECT points FROM scores WHERE player = ? AND anim = ?", (player, anim)).fetchone()
+        return None if points == None else points[0]
+
+
+    def _total(self, player: str=None) -> None:
+        # `player`'s total, or every total when None
+        if player != None and player in self.teams:
+            old = self.db.execute("SELECT total FROM totals WHERE player = ?", (player,)).fetchone()
+        self.db.execute(
+            "DELETE FROM totals" + ("" if player == None else " WHERE player = ?"),
+            () if player == None else (player,)
+        )
+        self.db.execute(
+            "INSERT INTO totals (player, total) "
+            "SELECT player, SUM(points * COALESCE(weight, 1)) FROM scores LEFT JOIN weights USING (anim) "
+            + ("" if player == None else "WHERE player = ? ")
+            + "GROUP BY player",
+            () if player == None else (player,)
+        )
+        if player == None:
+            points = ()
+            if len(self.teams) > 0:
+                points = chain(
+                    self.db.execute("SELECT player, anim, points FROM scores"),
+                    self.db.execute("SELECT player, NULL, total FROM totals")
+                )
+            self.teams.build(points)
+        elif player in self.teams:
+            new = self.db.execute("SELECT total FROM totals WHERE player = ?", (player,)).fetchone()
+            self.teams.change(player, None, None if old == None else old[0], None if new == None else new[0])
+
+
+    def _totals(self) -> None:
+        data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self.totals_version:
+            self._total()
+            self.totals_version = data_version
+            if self.readonly:
+                # ends the transaction opened by the rebuild, which would keep reading an old snapshot
+                self.db.commit()
+
+
+    def count_totals(self) -> int:
+        self._totals()
+        return self.db.execute("SELECT COUNT(*) FROM totals").fetchone()[0]
+
+
+    def top_totals(self, n: int=None, start: int=0) -> List[Tuple[str, float]]:
+        self._totals()
+        return self.db.execute(
+            "SELECT player, total FROM totals ORDER BY total DESC, player LIMIT ? OFFSET ?",
+            (-1 if n == None else n, start)
+        ).fetchall()
+
+
+    def total(self, player: str) -> float:
+        """Weighted sum of the points of `player`, None if not enrolled anywhere."""
+        self._totals()
+        total = self.db.execute("SELECT total FROM totals WHERE player = ?", (player,)).fetchone()
+        return None if total == None else total[0]
+
+
+    def total_rank(self, player: str) -> int:
+        total = self.total(player)
+        # two index range counts, cheaper than a single one with OR
+        return self.db.execute(
+            "SELECT (SELECT COUNT(*) FROM totals WHERE total > ?) "
+            "+ (SELECT COUNT(*) FROM totals WHERE total = ? AND player < ?) + 1",
+            (total, total, player)
+        ).fetchone()[0]
+
+
+    def set_team(self, player: str, team: str=None) -> None:
+        """Put `player` in `team`, or in no team if None, whether they are registered yet or not."""
+        self._totals()
+        scores = dict(self.db.execute("SELECT anim, points FROM scores WHERE player = ?", (player,)))
+        total = self.db.execute("SELECT total FROM totals WHERE player = ?", (player,)).fetchone()
+        if total != None:
+            scores[None] = total[0]
+        self.teams.assign(player, team, scores)
+        if team == None:
+            self.db.execute("DELETE FROM teams WHERE player = ?", (player,))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO teams (player, team) VALUES (?, ?)", (player, team))
+        self._touch()
+        self.dirty = True
+
+
+    def team(self, player: str) -> str:
+        return self.teams.get(player)
+
+
+    def top_teams(self, anim: str=None, n: int=None) -> List[Tuple[str, float]]:
+        """Teams ranked by the points of their players in `anim`, or by their totals if None."""
+        self._totals()
+        return self.teams.top(anim, n)
+
+
+    def read(self, player: str=None, anim: str=None):
+        if (
+            anim != None and not isinstance(anim, str) or
+            player != None and not isinstance(player, str)
+        ):
+            raise TypeError("Expected strings")
+
+        if (
+            anim != None and anim not in self.anims or
+            player != None and player not in self.players
+        ):
+            raise TypeError("Expected strings")
+
+        if anim != None:
+            if player != None:
+                return self.db.execute(
+                    "SELECT points FROM scores WHERE player = ? AND anim = ?", (player, anim)
+                ).fetchone()[0]
+            else:
+                return dict(self.db.execute("SELECT player, points FROM scores WHERE anim = ?", (anim,)))
+        else:
+            if player != None:
+                return dict(self.db.execute("SELECT anim, points FROM scores WHERE player = ?", (player,)))
+            else:
+                raise Exception("At least one arg must be specified")
+
+
+def convert(src_path: str, dest_path: str, teams_path: str=None) -> None:
+    # the teams of the `teams_path` file are imported along when converting to SQLite
+    src = Storage(src_path, teams_path=teams_path)
+    if dest_path.endswith(".db"):
+        dest = SqliteStorage(dest_path)
+        dest.db.executemany("INSERT OR IGNORE INTO players (name) VALUES (?)", ((p,) for p in src.players))
+        dest.db.executemany(
+            "INSERT OR REPLACE INTO scores (player, anim, points) VALUES (?, ?, ?)",
+            (row for row in src.rows() if row[1] != None)
+        )
+        dest.db.executemany("INSERT OR REPLACE INTO teams (player, team) VALUES (?, ?)", src.teams.mapping.items())
+        dest.save()
+    else:
+        src.path = dest_path
+        src.binary = dest_path.endswith(".bin")
+        src._write_snapshot(src._dump())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert between the storage formats: CSV (.csv), binary snapshot (.bin) and SQLite (.db)"
+    )
+    parser.add_argument("src", nargs="?", default="./storage.csv", help=".csv or .bin file")
+    parser.add_argument("dest", nargs="?", default="./storage.db", help=".csv, .bin or .db file")
+    parser.add_argument("--teams", help="player,team file imported into the SQLite database")
+
+    args = parser.parse_args()
+
+    convert(args.src, args.dest, args.teams)
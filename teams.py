@@ -0,0 +1,96 @@
+from typing import Dict, Iterable, List, Tuple
+
+from sortedcontainers import SortedList
+
+
+class Teams:
+    """
+    Player -> team mapping, along with the points of every team: the sum of
+    its players' points in each anim, and of their totals under the anim None.
+    Storages report every change of a player's points, so that the rankings
+    are adjusted rather than summed again over all the players. Teams are
+    ranked where at least one of their players is enrolled.
+    """
+
+    def __init__(self, mapping: Dict[str, str]=None):
+        self.mapping = dict(mapping or {})
+        # anim -> {team: [points, enrolled players]}
+        self.scores = {}
+        # anim -> (-points, team) kept sorted
+        self.leaderboards = {}
+
+
+    def __contains__(self, player: str) -> bool:
+        return player in self.mapping
+
+
+    def __len__(self) -> int:
+        return len(self.mapping)
+
+
+    def get(self, player: str) -> str:
+        return self.mapping.get(player)
+
+
+    def _apply(self, team: str, anim: str, old: float, new: float) -> None:
+        scores = self.scores.setdefault(anim, {})
+        leaderboard = self.leaderboards.setdefault(anim, SortedList())
+        score = scores.get(team)
+        if score == None:
+            score = scores[team] = [0, 0]
+        else:
+            leaderboard.remove((-score[0], team))
+        score[0] += (new or 0) - (old or 0)
+        score[1] += (new != None) - (old != None)
+        if score[1] > 0:
+            leaderboard.add((-score[0], team))
+        else:
+            scores.pop(team)
+            if len(scores) == 0:
+                self.scores.pop(anim)
+                self.leaderboards.pop(anim)
+
+
+    def change(self, player: str, anim: str, old: float, new: float) -> None:
+        """`player`'s points in `anim`, or total if None, went from `old` to `new`, None when not enrolled."""
+        team = self.mapping.get(player)
+        if team != None and old != new:
+            self._apply(team, anim, old, new)
+
+
+    def assign(self, player: str, team: str, scores: Dict[str, float]) -> None:
+        """Move `player` to `team`, or out of any team if None, `scores` being their points and total."""
+        old_team = self.mapping.pop(player, None)
+        if old_team != None:
+            for anim, points in scores.items():
+                self._apply(old_team, anim, points, None)
+        if team != None:
+            self.mapping[player] = team
+            for anim, points in scores.items():
+                self._apply(team, anim, None, points)
+
+
+    def build(self, points: Iterable[Tuple[str, str, float]]) -> None:
+        """
+        Sum the points of the teams again from the (player, anim, points) of
+        every enrollment and the (player, None, total) of every enrolled player,
+        faster than reporting them one by one when loading.
+        """
+        self.scores = {}
+        for player, anim, p in points:
+            team = self.mapping.get(player)
+            if team != None:
+                score = self.scores.setdefault(anim, {}).setdefault(team, [0, 0])
+                score[0] += p
+                score[1] += 1
+        self.leaderboards = {
+            anim: SortedList((-score[0], team) for team, score in scores.items())
+            for anim, scores in self.scores.items()
+        }
+
+
+    def top(self, anim: str=None, n: int=None) -> List[Tuple[str, float]]:
+        leaderboard = self.leaderboards.get(anim)
+        if leaderboard == None:
+            return []
+        return [(team, -points) for points, team in leaderboard.islice(0, n)]
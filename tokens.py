@@ -0,0 +1,47 @@
+import base64
+import binascii
+import hashlib
+import hmac
+
+# bytes of HMAC-SHA256 kept in a token, the start parameter of a Telegram link being at most 64 characters
+SIGNATURE_SIZE = 12
+
+
+def _signature(player: bytes, secret: bytes) -> bytes:
+    return hmac.new(secret, player, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+
+def sign(player: str, secret: bytes) -> str:
+    """
+    Token of a player's card: their name signed with the event's secret, in
+    URL-safe base64 without padding, as Telegram links only allow [A-Za-z0-9_-].
+    """
+    name = player.encode("utf-8")
+    return base64.urlsafe_b64encode(_signature(name, secret) + name).decode("ascii").rstrip("=")
+
+
+def verify(token: str, secret: bytes) -> str:
+    """Return the player a token was signed for, None if it was not signed with `secret` or is malformed."""
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    signature, name = data[:SIGNATURE_SIZE], data[SIGNATURE_SIZE:]
+    # compared in constant time, so that the signature can't be guessed byte by byte
+    if len(name) == 0 or not hmac.compare_digest(signature, _signature(name, secret)):
+        return None
+    try:
+        return name.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+def read_legacy(payload: str, code: str) -> str:
+    """Return the player of a card written before tokens were signed, None if the payload is not one."""
+    try:
+        player, card_code = base64.b64decode(payload).decode("utf-8").split()
+    except (binascii.Error, ValueError):
+        return None
+    if not hmac.compare_digest(card_code.encode("utf-8"), code.encode("utf-8")):
+        return None
+    return player